@@ -1,345 +1,3876 @@
 #!/usr/bin/env python
 
-from datetime import datetime
+import bisect
+import copy
+from datetime import datetime, timedelta
 import getopt
+import glob
+import hashlib
+import heapq
+import json
+import mimetypes
+import mmap
+import multiprocessing
 import os
+import platform
+import random
 import re
 import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlsplit
 
 __author__ = "Erik Smartt"
 __copyright__ = "Copyright 2010-2011, Erik Smartt"
 __license__ = "MIT"
-__version__ = "0.2.18"
+__version__ = "0.3.0"
+
+__usage__ = """Normal usage:
+  jsmacro.py -f [INPUT_FILE_NAME] > [OUTPUT_FILE]
+
+  Options:
+   --def [VAR[=VALUE]]    Defines the supplied variable (with a default value of 0) in the parser environment.
+   --engine [NAME]        Selects the parser engine: 'scan' (single-pass, the default) or 'regex' (the original multi-pass engine).
+   -f|--file [FILE]       Used to load a single input file. Use '-' to read from stdin (which implies --stream.)
+   --bundle [FILE] [INPUT ...]
+                          Processes the INPUT files (which may be glob patterns, e.g. 'src/*.js') in order, with a
+                          shared environment, into the single file FILE ('-' for stdout.) Each file is output once:
+                          //@include_once skips files that are already in the bundle.
+   --replace              Replace each identifier that names a defined variable (with --def or //@define) with its value,
+                          e.g. 'API_URL' with '"https://example.com"'. Comments and strings are left alone.
+   --compact              Remove the blank lines and trailing whitespace left where macros were removed (runs of blank
+                          lines that contained a macro are collapsed to one), and report the bytes saved per file.
+                          Whitespace that was in the source away from the macros is kept. (With --stream, only
+                          within each block of output.)
+   --timestamp [SECONDS]  The time @__date__, @__time__ and @__datetime__ stand for in every file, in seconds since the
+                          epoch (UTC.) Defaults to $SOURCE_DATE_EPOCH, or else the time the run started.
+   --stream               Process -f|--file one line at a time, writing output as soon as it's known. Memory use doesn't
+                          grow with the size of the file, but each //@define only applies to the lines after it.
+   -s|--srcdir [DIR]      Used to process all files in the specified directory. Use with -d|--dstdir
+   -d|--dstdir [DIR]      Used to output files processed using -s|--srcdir into the specified directory.
+   -e|--exclude [DIR]     Exclude the files in [DIR] (relative to the directory given in -s|--srcdir).
+   --incremental          Only re-process the files (found with -s|--srcdir) whose source, included files or relevant
+                          defines changed since the last run. The state is kept in [DIR]/.jsmacro-manifest.json.
+   --watch                Keep running after processing -s|--srcdir, and re-process the files that change (and the files
+                          that include them) whenever the source tree changes.
+   --interval [SECONDS]   How often --watch polls the source tree for changes (default 0.5.)
+   --assets [STRATEGY]    How -s|--srcdir puts the non-js files into -d|--dstdir: 'update' (copy, skipping the files whose
+                          size and mtime already match, the default), 'copy', 'hardlink' or 'symlink'.
+   --shard [K/N]          Only process the files (found with -s|--srcdir) in shard K of N (K from 1 to N), picked by a
+                          hash of their path relative to -s|--srcdir, and list them in [DIR]/.jsmacro-shard-K-of-N.json.
+   --merge [DIR] [SHARDDIR ...]
+                          Checks that the --shard builds in the SHARDDIRs (or in DIR, if none are given) cover every
+                          file of the source tree exactly once, and if so copies their outputs into DIR.
+   --testshards [N]       Builds -s|--srcdir (given before it), or a small generated tree, as N --shard processes into
+                          temporary directories, merges them, and checks the result against a build without --shard.
+   -j|--jobs [NUM]        Process the files found with -s|--srcdir using NUM processes (default 1).
+   --variant [NAME[:VAR[=VALUE],...]]
+                          Adds a named set of defines (on top of any --def) to build with -s|--srcdir. May be repeated;
+                          each variant is written to its own [DIR]/NAME directory in a single pass over the source tree.
+   --stats [FORMAT]       After -f|--file or -s|--srcdir, writes the time spent in each stage of the parse, the bytes in
+                          and out, the macros handled and the include cache use, for each file and in total, to stderr.
+                          FORMAT is 'text' or 'json'.
+   --serve                Serve -s|--srcdir over HTTP instead of writing it to -d|--dstdir. .js files are processed (with
+                          the --def values) when they're requested; the output is kept in memory until the file, or
+                          a file it includes, changes.
+   --port [PORT]          The port --serve listens on (default 8000, on 127.0.0.1.)
+   --help                 Prints this Help message.
+   --bench                Times each stage of MacroEngine.parse, and -s|--srcdir end to end, on synthetic source trees
+                          for jsmacro.py and jsmacro_25.py, and prints the results as JSON.
+   --benchscale [NAME]    Runs --bench on the named corpus only: small, medium, large or dense. May be repeated.
+   --benchlines           Times @__line__ substitution on generated files of increasing length.
+   --savefail             Saves the parsed output of a failed test case to disk.
+   --testall              Run the test suite (over -j|--jobs processes.) Tests are numbered in the sorted order of their paths.
+   --test [NUM]           Run test number NUM only.
+   --junit [FILE]         Also write the results of --testall or --test to FILE, as JUnit XML.
+   --testjson [FILE]      Also write the results of --testall or --test to FILE, as JSON.
+   --version              Print the version number of jsmacro being used.
+"""
+
+timer = getattr(time, 'perf_counter', time.time)
+
+__credits__ = [
+    'aliclark <https://github.com/aliclark>',
+    'Rodney Lopes Gomes <https://github.com/rlgomes>',
+    'Elan Ruusamae <https://github.com/glensc>',
+]
+
+DEFINE_DEFAULT = '0'
+
+ENGINE_SCAN = 'scan'
+ENGINE_REGEX = 'regex'
+ENGINES = (ENGINE_SCAN, ENGINE_REGEX)
+
+MANIFEST_NAME = '.jsmacro-manifest.json'
+
+# Written by each --shard K/N build, and read by --merge.
+SHARD_MANIFEST_NAME = '.jsmacro-shard-{k}-of-{n}.json'
+SHARD_MANIFEST_GLOB = '.jsmacro-shard-*-of-*.json'
+
+# With --compact, marks the places macros were removed from the output, until compact_output() takes them out.
+COMPACT_MARK = '\x00'
+
+# With the regex engine, marks where an //@include_once goes, until resolve_once() knows which blocks are output.
+ONCE_MARK = '\x01'
+
+WATCH_INTERVAL = 0.5
+
+ASSET_UPDATE = 'update'
+ASSET_COPY = 'copy'
+ASSET_HARDLINK = 'hardlink'
+ASSET_SYMLINK = 'symlink'
+ASSET_STRATEGIES = (ASSET_UPDATE, ASSET_COPY, ASSET_HARDLINK, ASSET_SYMLINK)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Synthetic corpora for --bench. 'density' is the share of lines holding a directive, 'depth' how deeply the
+# //@if blocks nest, 'fanout' the //@includes per file, and 'line_density' the share of lines using @__line__.
+BENCH_SCALES = {
+    'small': {'files': 20, 'lines': 200, 'density': 0.05, 'depth': 1, 'fanout': 1, 'line_density': 0.01},
+    'medium': {'files': 100, 'lines': 1000, 'density': 0.1, 'depth': 4, 'fanout': 2, 'line_density': 0.05},
+    'large': {'files': 100, 'lines': 5000, 'density': 0.2, 'depth': 8, 'fanout': 4, 'line_density': 0.1},
+    'dense': {'files': 20, 'lines': 2000, 'density': 0.5, 'depth': 16, 'fanout': 8, 'line_density': 0.5},
+}
+BENCH_DEFAULT_SCALES = ('small', 'medium', 'large')
+BENCH_MODULES = ('jsmacro.py', 'jsmacro_25.py')
+BENCH_REPEAT = 3
+
+TEST_SLOWEST = 5
+
+# The build time the test runner uses (Feb 19, 2010 08:30PM), so the tests' output doesn't depend on when they run.
+TEST_SOURCE_DATE_EPOCH = 1266611400
+
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8000
+
+STATS_TEXT = 'text'
+STATS_JSON = 'json'
+STATS_FORMATS = (STATS_TEXT, STATS_JSON)
+
+
+class MacroError(Exception):
+    """
+    Raised when a source file can't be processed. The message starts with the file:line at fault.
+    """
+    pass
+
+
+class Expression(object):
+    """
+    A compiled //@if condition or //@define value. The expression language has literals (numbers,
+    'strings', true/false), variable names, ! (or not), && (or and), || (or or), the comparisons
+    == != < <= > >=, and parentheses.
+
+    Expressions are parsed once into a tree of closures, and cached by their text (see compile()),
+    so a condition repeated across thousands of files is only parsed once per process.
+    """
+    re_token = re.compile(r"""\s*(?:(\d+\.\d*|\.\d+|\d+)|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|([A-Za-z_]\w*)|(&&|\|\||===|!==|==|!=|<=|>=|[!<>()]))""")
+    re_escape = re.compile(r"\\(.)")
+
+    keywords = {'and': '&&', 'or': '||', 'not': '!'}
+    constants = {'true': True, 'True': True, 'false': False, 'False': False, 'null': None, 'None': None}
+    comparisons = {
+        '==': lambda a, b: a == b,
+        '===': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '!==': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+    orderings = frozenset(['<', '<=', '>', '>='])
+
+    _cache = {}
+
+    @classmethod
+    def compile(cls, text):
+        """
+        Returns the (cached) Expression for 'text'. Raises a MacroError if it isn't valid.
+        """
+        expression = cls._cache.get(text)
+
+        if expression is None:
+            expression = cls(text)
+            cls._cache[text] = expression
+
+        return expression
+
+    def __init__(self, text):
+        self.text = text
+        self.names = set()
+        self.tokens = self.tokenize(text)
+        self.pos = 0
+
+        self.evaluate = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.fail("unexpected '{t}'".format(t=self.tokens[self.pos][1]))
+
+        del self.tokens
+
+    def __call__(self, lookup):
+        """
+        Evaluates the expression. 'lookup' returns the value of a variable, and raises a KeyError
+        for the ones that aren't defined.
+        """
+        return self.evaluate(lookup)
+
+    def fail(self, message):
+        raise MacroError("invalid expression '{e}': {m}".format(e=self.text, m=message))
+
+    def tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+
+        while pos < len(text):
+            mo = self.re_token.match(text, pos)
+            if mo is None:
+                self.fail("unexpected '{t}'".format(t=text[pos:].strip()[:10]))
+
+            number, string, name, op = mo.groups()
+
+            if number is not None:
+                tokens.append(('value', float(number) if '.' in number else int(number)))
+            elif string is not None:
+                tokens.append(('value', self.re_escape.sub(r"\1", string[1:-1])))
+            elif name in self.keywords:
+                tokens.append(('op', self.keywords[name]))
+            elif name in self.constants:
+                tokens.append(('value', self.constants[name]))
+            elif name is not None:
+                tokens.append(('name', name))
+            else:
+                tokens.append(('op', op))
+
+            pos = mo.end()
+
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+        return (None, None)
+
+    def parse_or(self):
+        left = self.parse_and()
+
+        while self.peek() == ('op', '||'):
+            self.pos += 1
+            right = self.parse_and()
+            left = (lambda a, b: lambda lookup: a(lookup) or b(lookup))(left, right)
+
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+
+        while self.peek() == ('op', '&&'):
+            self.pos += 1
+            right = self.parse_not()
+            left = (lambda a, b: lambda lookup: a(lookup) and b(lookup))(left, right)
+
+        return left
+
+    def parse_not(self):
+        if self.peek() == ('op', '!'):
+            self.pos += 1
+            operand = self.parse_not()
+            return lambda lookup: not operand(lookup)
+
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_atom()
+
+        kind, op = self.peek()
+        if kind == 'op' and op in self.comparisons:
+            self.pos += 1
+            right = self.parse_atom()
+            compare = self.comparisons[op]
+
+            if op in self.orderings:
+                return lambda lookup: self.order(compare, op, left(lookup), right(lookup))
+
+            return lambda lookup: compare(left(lookup), right(lookup))
+
+        return left
+
+    def order(self, compare, op, a, b):
+        """
+        Compares two numbers, or two strings. Anything else (e.g. 1 < 'a', or null > 1) raises a
+        MacroError, on Python 2 as on Python 3.
+        """
+        kinds = [(isinstance(v, (int, float)) and 'number') or (isinstance(v, (str, type(u''))) and 'string') for v in (a, b)]
+
+        if not kinds[0] or kinds[0] != kinds[1]:
+            self.fail("can't compare {a} {o} {b}".format(a=json.dumps(a), o=op, b=json.dumps(b)))
+
+        return compare(a, b)
+
+    def parse_atom(self):
+        kind, value = self.peek()
+        self.pos += 1
+
+        if kind == 'value':
+            return lambda lookup: value
+
+        if kind == 'name':
+            self.names.add(value)
+            return lambda lookup: lookup(value)
+
+        if (kind, value) == ('op', '('):
+            inner = self.parse_or()
+            if self.peek() != ('op', ')'):
+                self.fail("missing ')'")
+
+            self.pos += 1
+            return inner
+
+        if kind is None:
+            self.fail("unexpected end")
+
+        self.fail("unexpected '{t}'".format(t=value))
+
+
+class LineIndex(object):
+    """
+    Maps character offsets in a text to (1-based) line numbers. The index is built with a single
+    pass over the text, and each lookup is a binary search over the line start offsets.
+    """
+    re_newline = re.compile("\n")
+
+    def __init__(self, text, file_name=None):
+        self.file_name = file_name
+        self.starts = [0] + [mo.end() for mo in self.re_newline.finditer(text)]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line(self, offset):
+        return bisect.bisect_right(self.starts, offset)
+
+    def location(self, offset):
+        return "{f}:{l}".format(f=self.file_name, l=self.line(offset))
+
+
+class ParseStats(object):
+    """
+    Timings and counters for a MacroEngine, when stats are turned on (see
+    MacroEngine.enable_stats().) There is one record per file parsed, and the engine adds them up
+    in its 'stats' total.
+
+    'seconds' maps each stage to the time spent in it. The regex engine's stages are 'read', 'line'
+    (@__line__), 'builtins' (the other @__foo__ substitutions), 'define', 'include', 'strip' and
+    'wrapped'; the scan engine's are 'read', 'scan', 'include' and 'render' ('stream' with
+    parse_stream.) The time spent on an included file is all counted under 'include'.
+
+    'directives' counts each kind of macro handled (including the ones in included files.)
+    """
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        self.files = 0
+        self.seconds = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_saved = 0
+        self.directives = {}
+        self.include_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.nested = 0  # How many includes deep the engine is; stages are only timed at the top.
+
+    def lap(self, stage, started):
+        """
+        Adds the time since 'started' to 'stage', and returns the current time for the next lap.
+        """
+        now = timer()
+
+        if not self.nested:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + now - started
+
+        return now
+
+    def count(self, directive, number=1):
+        if number:
+            self.directives[directive] = self.directives.get(directive, 0) + number
+
+    def add(self, other):
+        """
+        Adds another record to this one.
+        """
+        self.files += other.files
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.bytes_saved += other.bytes_saved
+        self.include_depth = max(self.include_depth, other.include_depth)
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+        for directive, number in other.directives.items():
+            self.count(directive, number)
+
+    def as_dict(self):
+        return {
+            'file': self.file_name,
+            'files': self.files,
+            'seconds': dict(self.seconds),
+            'total_seconds': sum(self.seconds.values()),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_saved,
+            'directives': dict(self.directives),
+            'include_depth': self.include_depth,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+    def report(self):
+        """
+        Returns the record as a few lines of text.
+        """
+        lines = ["{f}: {n} files, {t:.2f} ms, {i} bytes in, {o} bytes out".format(
+            f=self.file_name or 'Total', n=self.files, t=sum(self.seconds.values()) * 1000.0, i=self.bytes_in, o=self.bytes_out)]
+
+        if self.seconds:
+            lines.append("  stages: " + ", ".join("{s} {t:.2f} ms".format(s=s, t=t * 1000.0) for s, t in sorted(self.seconds.items())))
+
+        if self.directives:
+            lines.append("  directives: " + ", ".join("{d} {n}".format(d=d, n=n) for d, n in sorted(self.directives.items())))
+
+        if self.bytes_saved:
+            lines.append("  compact: {b} bytes saved".format(b=self.bytes_saved))
+
+        lines.append("  include depth {d}, include cache: {h} hits, {m} misses".format(d=self.include_depth, h=self.cache_hits, m=self.cache_misses))
+
+        return "\n".join(lines)
+
+
+def stats_report(total, files, format=STATS_TEXT):
+    """
+    Formats the per-file ParseStats records and their total, as text or JSON.
+    """
+    if format == STATS_JSON:
+        return json.dumps({'files': [stats.as_dict() for stats in files], 'total': total.as_dict()}, indent=2, sort_keys=True)
+
+    return "\n".join([stats.report() for stats in files] + [total.report()])
+
+
+class CompiledSource(object):
+    """
+    The compiled form of a source file, as returned by MacroEngine.compile(). It holds a tree of
+    text segments, //@include and wrapped macro nodes that MacroEngine.render() can output for
+    any number of environments without scanning the text again.
+
+    'defines' lists the (key, value) pairs of the file's //@define statements, in order, and
+    'names' is the set of variables the file (and the files it includes) define or test.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tokens = []
+        self.defines = []
+        self.includes = []
+        self.names = set()
+        self._once_paths = None
+
+    def once_paths(self):
+        """
+        Returns (and remembers) the set of files this file includes with //@include_once, directly
+        or not.
+        """
+        if self._once_paths is None:
+            self._once_paths = self.included_paths(once=True)
+
+        return self._once_paths
+
+    def included_paths(self, once=False):
+        """
+        Returns the set of files included by this file, directly or not. With 'once', only the
+        ones included with //@include_once.
+        """
+        paths = set()
+        seen = set()
+        stack = list(self.includes)
+
+        while stack:
+            include = stack.pop()
+            if (include.path, include.once) not in seen:
+                seen.add((include.path, include.once))
+                stack.extend(include.compiled.includes)
+
+                if include.once or not once:
+                    paths.add(include.path)
+
+        return paths
+
+
+class _Include(object):
+    """
+    An //@include (or //@include_once) found by the scan engine. The path is resolved when the line
+    is scanned, and the included file is compiled along with the file that includes it.
+    """
+    def __init__(self, path, location, once=False):
+        self.path = path
+        self.location = location
+        self.once = once
+        self.compiled = None
+
+
+class _LineMacro(object):
+    """
+    A line macro registered with MacroEngine.register_line(), found by the scan engine. Its
+    handler is called when the file is rendered, so its output can depend on the env.
+    """
+    def __init__(self, name, arg, location):
+        self.name = name
+        self.arg = arg
+        self.location = location
+
+
+class _Block(object):
+    """
+    A wrapped macro (//@if, //@ifdef, ...) found by the scan engine.
+
+    'branches' holds the token lists found between the opening line, each //@else line, and the
+    closing //@end line. 'separators' holds the text of the //@else lines themselves so that the
+    block can be rebuilt unmodified when needed.
+    """
+    def __init__(self, name, arg, opener, location):
+        self.name = name
+        self.arg = arg
+        self.opener = opener
+        self.location = location
+        self.branches = [[]]
+        self.separators = []
+        self.closed = False
+        self.one_line = False  # Opened and closed on the same line, e.g. in a string.
+
+
+class _InlineFunction(object):
+    """
+    A function defined in an //@inline block, whose calls MacroEngine.inline_calls() replaces
+    with 'body' (the expression it returns), after substituting the arguments for 'params'.
+    """
+    def __init__(self, name, params, body, location):
+        self.name = name
+        self.params = params
+        self.body = body
+        self.location = location
+
+        # Matches the parameters in the body, skipping comments, strings and property names.
+        self.re_param = re.compile("({s})|(?<![\\w$.])({p})(?![\\w$])".format(
+            s=MacroEngine.re_replace_skip, p="|".join(re.escape(param) for param in params) or "(?!)"), re.S)
+
+
+class _Scanner(object):
+    """
+    Turns the text of a source file into a CompiledSource, for MacroEngine.scan() and
+    MacroEngine.parse_stream(). Text without any markers is added with text(), and each line
+    that might hold a macro goes through line().
+    """
+    def __init__(self, engine, file_name):
+        now = engine.build_timestamp()
+        self.line_markers = engine.line_markers()
+
+        self.engine = engine
+        self.file_name = file_name
+        self.basepath = engine.source_dir(file_name)
+
+        self.builtins = {
+            '__file__': engine.source_name(file_name),
+            '__date__': now.strftime("%b %d, %Y"),
+            '__time__': now.strftime("%I:%M%p"),
+            '__datetime__': now.strftime("%b %d, %Y %I:%M%p"),
+        }
+
+        self.compiled = CompiledSource(file_name)
+        self.out = self.compiled.tokens  # Where text goes; either the top level, or a branch of the innermost open block.
+        self.blocks = []                 # The stack of open blocks.
+
+    def text(self, text):
+        self.out.append(text)
+
+    def line(self, line, line_num):
+        engine = self.engine
+        stats = engine.file_stats
+        mark = COMPACT_MARK if engine.compact else ''
+        location = "{f}:{l}".format(f=self.file_name, l=line_num)
+
+        if '__' in line:
+            self.builtins['__line__'] = '{l}'.format(l=line_num)
+            line, subs = engine.re_builtin_sub_macro.subn(lambda m: self.builtins[m.group(1).lower()], line)
+
+            if stats is not None:
+                stats.count('builtin', subs)
+
+            if '//' not in line and not self.line_markers:
+                self.out.append(line)
+                return
+
+        mo = engine.re_define_macro.search(line)
+        if mo:
+            self.compiled.defines.append((mo.group(2), mo.group(4) or DEFINE_DEFAULT))
+            self.compiled.names.add(mo.group(2))
+            self.add_names(mo.group(4))
+            line = line[:mo.start()] + mark + line[mo.end():]
+
+            if stats is not None:
+                stats.count('define')
+
+        mo = engine.re_include_macro.search(line)
+        if mo:
+            if stats is not None:
+                stats.count('include_once' if mo.group(2) else 'include')
+
+            self.out.append(line[:mo.start()])
+            include = _Include(engine.include_path(self.basepath, mo.group(3).strip()), location, bool(mo.group(2)))
+            self.compiled.includes.append(include)
+            self.out.append(include)
+            line = line[mo.end():]
+
+        mo = engine.re_stripline_macro.search(line)
+        if mo:
+            line = line[:mo.start()] + mark + line[mo.end():]
+
+            if stats is not None:
+                stats.count('strip')
+
+        for name, (pattern, handler) in engine.line_macros.items():
+            mo = pattern.search(line)
+            if mo:
+                self.out.append(line[:mo.start()] + mark)
+                self.out.append(_LineMacro(name, (mo.group(1) or '').strip() if mo.groups() else '', location))
+                line = line[mo.end():]
+
+                if stats is not None:
+                    stats.count(name)
+
+        # What's left may open, split or close wrapped macros, in the order they appear on the line.
+        while line:
+            start = engine.re_block_start.search(line)
+            while start and not engine.is_block_macro(start.group(2)):
+                if start.group(2) not in engine.known_macros and start.group(2) not in engine.line_macros:
+                    engine.warn("unknown macro {m}, leaving it unmodified.".format(m=start.group(0).strip()), location)
+
+                start = engine.re_block_start.search(line, start.start(2))
+
+            if self.blocks and self.blocks[-1].one_line:
+                found = [mo for mo in (start, engine.re_line_block_end.search(line), engine.re_line_block_else.search(line)) if mo]
+            else:
+                found = [mo for mo in (start, engine.re_block_end.search(line), engine.re_block_else.search(line)) if mo]
+
+            if not found:
+                self.out.append(line)
+                break
+
+            mo = min(found, key=lambda m: m.start())
+            self.out.append(line[:mo.start()])
+            line = line[mo.end():]
+
+            if stats is not None:
+                stats.count(start.group(2) if mo is start else mo.group(0).strip()[3:])
+
+            if mo is start:
+                block = _Block(mo.group(2), mo.group(3), mo.group(0), location)
+                body = None
+
+                if not mo.group(4) and line.startswith('//') and engine.re_line_block_end.search(line):
+                    arg = engine.re_line_block_arg.match(mo.group(3))
+                    if arg:
+                        block.arg = arg.group(1)
+                        block.one_line = True
+                        body = mo.group(3)[arg.end():]
+
+                self.add_names(block.arg)
+                self.out.append(block)
+                self.blocks.append(block)
+                self.out = block.branches[0]
+
+                if body:
+                    self.out.append(body)
+
+            elif not self.blocks:
+                engine.warn("{m} without a matching opening macro, leaving it unmodified.".format(m=mo.group(0).strip()), location)
+                self.out.append(mo.group(0))
+
+            elif mo.group(0).strip().endswith('else'):
+                block = self.blocks[-1]
+                block.separators.append(mo.group(0))
+                block.branches.append([])
+                self.out = block.branches[-1]
+
+            else:
+                self.blocks.pop().closed = True
+                self.out = self.blocks[-1].branches[-1] if self.blocks else self.compiled.tokens
+
+    def add_names(self, expression):
+        """
+        Records the variables used by an expression. Invalid expressions are reported when
+        they're evaluated.
+        """
+        if expression:
+            try:
+                self.compiled.names.update(Expression.compile(expression).names)
+
+            except MacroError:
+                pass
+
+    def finish(self):
+        """
+        Warns about the blocks still open at the end of the file. They're output unmodified.
+        """
+        for block in reversed(self.blocks):
+            self.engine.warn("{m} has no matching //@end, leaving it unmodified.".format(m=block.opener.strip()), block.location)
+
+        self.blocks = []
+        self.out = self.compiled.tokens
+
+
+class MacroEngine(object):
+    """
+    The MacroEngine is where the magic happens. It defines methods that are called
+    to handle the macros found in a document.
+    """
+    def __init__(self, engine=ENGINE_SCAN):
+        self.save_failure_output = False
+        self.engine = engine
+
+        self.re_else_pattern = '[\t ]*//[@#]else[\r]?[\n]'
+
+        # Compile the main patterns
+        self.re_define_macro = re.compile("([\t ]*//[@#]define[\t ]+)(\w+)([\t ]+([^\r\n]*?))?[\t ]*[\r]?[\n]", re.I)
+        self.re_define_cmdline_macro = re.compile("(\w+)[\=](.+)", re.I)
+        self.re_include_macro = re.compile("([\t ]*//[@#]include(_once)?[\t ]+)([^\r\n]+)[\r]?[\n]", re.I)
+
+        self.re_date_sub_macro = re.compile("[@#]__date__", re.I)
+        self.re_time_sub_macro = re.compile("[@#]__time__", re.I)
+        self.re_datetime_sub_macro = re.compile("[@#]__datetime__", re.I)
+        self.re_file_sub_macro = re.compile("[@#]__file__", re.I)
+        self.re_line_sub_macro = re.compile("[@#]__line__", re.I)
+
+        self.re_stripline_macro = re.compile(".*//[@#]strip.*[\r]?[\n]", re.I)
+        self.re_once_mark = re.compile(ONCE_MARK + "(\\d+)" + ONCE_MARK)
+
+        # A wrapped macro takes the following form:
+        #
+        # //@MACRO <ARGUMENTS>
+        # ...some code
+        # //@end
+        #
+        # The arguments are optional (e.g. for //@inline.)
+        self.re_wrapped_macro = re.compile("([\t ]*//[@#])(?!end|else)([a-z]+)(?:[\t ]+|(?=[\r\n]))([^\r\n]*[\r]?[\n])(.*?)([\t ]*//[@#]end(if)?)\s*?[\r]?[\n]", re.M | re.S)
+
+        # The scan engine looks at one line at a time, so it uses line-sized versions of the
+        # patterns above. Any line that doesn't contain a marker is passed through untouched.
+        self.re_scan_marker = re.compile("//[@#]|[@#]__")
+        self.re_scan_marker_bytes = re.compile(self.re_scan_marker.pattern.encode('ascii'))
+        self.re_builtin_sub_macro = re.compile("[@#](__(line|file|datetime|date|time)__)", re.I)
+        self.re_block_start = re.compile("([\t ]*//[@#])([a-z]+)(?:[\t ]+|(?=\r?\n|$))([^\r\n]*?)[\t ]*(\r?\n|$|(?=//[@#]))")
+        self.re_block_else = re.compile(self.re_else_pattern)
+        self.re_block_end = re.compile("[\t ]*//[@#]end(if|ifdef|ifndef)?\s*?[\r]?[\n]")
+
+        # A block can also be opened and closed within a line: '//@ifdef FOO text//@else other//@endifdef'. Its
+        # argument is then the first word (or bracketed expression) after the macro.
+        self.re_line_block_arg = re.compile("(\\([^\r\n]*?\\)|\\S+)[\t ]?")
+        self.re_line_block_else = re.compile("//[@#]else(?![\\w$])")
+        self.re_line_block_end = re.compile("//[@#]end(if|ifdef|ifndef)?(?![\\w$])")
+
+        # //@inline looks for function definitions, and for calls to the functions it found.
+        self.re_inline_function = re.compile("(?:\\bfunction[\t ]+([A-Za-z_$][\\w$]*)|\\b(?:var|let|const)[\t ]+([A-Za-z_$][\\w$]*)[\t ]*=[\t ]*function)[\t ]*\\(([^()]*)\\)\\s*\\{")
+        self.re_inline_return = re.compile("\\s*return\\b(.*?);?\\s*$", re.S)
+        self.re_inline_simple = re.compile("(?:[A-Za-z_$][\\w$]*(?:\\.[A-Za-z_$][\\w$]*|\\[(?:[A-Za-z_$][\\w$]*|\\d+)\\])*|-?\\d+(?:\\.\\d*)?|'[^'\\\\\\n]*'|\"[^\"\\\\\\n]*\")$")
+        self.re_js_skip = re.compile(self.re_replace_skip, re.S)
+
+        # The dispatch tables, from each macro's name to its handlers. See register_block() and register_line().
+        self.block_macros = {}
+        self.line_macros = {}
+        self.register_methods()
+
+        self._include_stack = []
+        self.include_resolver = None
+        self.srcdir = None
+        self.build_time = None
+        self._clock_time = None
+        self.replace_defines = False
+        self.compact = False
+        self.compact_saved = 0
+        self.stats = None
+        self.stats_hook = None
+        self.file_stats = None
+        self.warnings = None  # Where warn() writes, when not to sys.stdout (e.g. sys.stderr while the output goes to stdout.)
+        self.clear_caches()
+        self.reset()
+
+    def spawn(self, env=None, include_resolver=None):
+        """
+        Returns a copy of the engine for a single call (or a single thread.) The copy shares the
+        engine's configuration (patterns, handlers and stats), but has its own env, caches and
+        include state, so the original engine can be shared by any number of threads.
+
+        @param    env                 Dictionary    The env to start from (a copy of this engine's env by default.)
+        @param    include_resolver    Function      See read_source().
+        """
+        self.build_timestamp()
+
+        engine = copy.copy(self)
+        engine.block_macros = dict(self.block_macros)
+        engine.line_macros = dict(self.line_macros)
+        engine._include_stack = []
+        engine.include_resolver = include_resolver
+        engine.clear_caches()
+        engine.reset(self.env if env is None else env)
+
+        return engine
+
+    def parse_string(self, text, name='<string>', env=None, include_resolver=None):
+        """
+        Parses source text held in memory, and returns the output. The call has its own state (see
+        spawn()), so this engine, and its env, are left untouched.
+
+        @param    text                String        The source.
+        @param    name                String        The name of the source, used for @__file__, warnings and relative //@includes.
+        @param    env                 Dictionary    Variables to start from (a copy of this engine's env by default.)
+        @param    include_resolver    Function      Returns the text of an included file (see read_source()), so nothing
+                                                    needs to be read from disk.
+        """
+        return self.spawn(env, include_resolver).parse(name, text)
+
+    def parse_many(self, sources, env=None, include_resolver=None):
+        """
+        Parses each (name, text) pair from 'sources', yielding (name, output) pairs. Each source
+        starts from 'env' (as for parse_string()), and a file included by several sources is only
+        resolved and compiled once.
+        """
+        engine = self.spawn(env, include_resolver)
+        seed_env = engine.env
+
+        for name, text in sources:
+            engine.reset(seed_env)
+            yield name, engine.parse(name, text)
+
+    def read_source(self, file_name):
+        """
+        Returns the text of a source file. With an include_resolver, the text comes from calling
+        include_resolver(file_name) instead of the disk; the file name is then the normalized
+        path of the file relative to the sources' names, e.g. 'lib/util.js'. The resolver returns
+        None (or raises an IOError) for files it doesn't know.
+        """
+        if self.include_resolver is not None:
+            text = self.include_resolver(file_name)
+            if text is None:
+                raise IOError("{f} not found by the include resolver".format(f=file_name))
+
+            return text
+
+        fp = open(file_name, 'r')
+        text = fp.read()
+        fp.close()
+
+        return text
+
+    def has_markers(self, file_name):
+        """
+        Returns True if a file contains anything that looks like a macro (see re_scan_marker and
+        line_markers.) The file is memory-mapped and searched as bytes, so it's never decoded or
+        copied into memory. A file without markers would come out of parse() unchanged.
+        """
+        markers = [self.re_scan_marker_bytes]
+
+        for pattern in self.line_markers():
+            source = pattern.pattern
+            if not isinstance(source, bytes):
+                source = source.encode('utf-8')
+
+            try:
+                markers.append(re.compile(source, pattern.flags & ~re.U))
+
+            except (re.error, ValueError):
+                # It can't be searched for as bytes, so the file has to be parsed.
+                return True
+
+        def search(data):
+            return any(marker.search(data) is not None for marker in markers)
+
+        fp = open(file_name, 'rb')
+
+        try:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+            except (ValueError, EnvironmentError):
+                # Empty files can't be mapped (and some file systems can't map at all.)
+                return search(fp.read())
+
+            try:
+                return search(data)
+
+            finally:
+                data.close()
+
+        finally:
+            fp.close()
+
+    def source_key(self, path):
+        """
+        Returns the name a source file is known by in the include stack and caches: its real path,
+        or just its normalized path when the sources come from an include_resolver.
+        """
+        if self.include_resolver is not None:
+            return os.path.normpath(path)
+
+        return os.path.realpath(path)
+
+    def source_name(self, file_name):
+        """
+        Returns what @__file__ stands for in a file: its path relative to self.srcdir (with '/'
+        separators) when that is set, so the output doesn't depend on where the tree is, or else
+        file_name as it was given.
+        """
+        if self.srcdir is None or file_name == '-':
+            return file_name
+
+        return os.path.relpath(file_name, self.srcdir).replace(os.sep, '/')
+
+    def build_timestamp(self):
+        """
+        Returns the time @__date__, @__time__ and @__datetime__ stand for. It is taken the first
+        time it's needed, and kept, so every file of a run gets the same one: the SOURCE_DATE_EPOCH
+        environment variable (in seconds since the epoch) if it's set, or else the current time.
+        Setting self.build_time overrides both.
+        """
+        if self.build_time is None:
+            epoch = os.environ.get('SOURCE_DATE_EPOCH')
+            if epoch:
+                self.build_time = epoch_datetime(epoch, 'SOURCE_DATE_EPOCH')
+            else:
+                self.build_time = self._clock_time = datetime.now()
+
+        return self.build_time
+
+    def fixed_build_time(self):
+        """
+        Returns the build time if it was set (with self.build_time or SOURCE_DATE_EPOCH), or None
+        if it's the time the run started.
+        """
+        build_time = self.build_timestamp()
+
+        return None if build_time is self._clock_time else build_time
+
+    def get_settings(self):
+        """
+        Returns the configuration a worker process needs to set up an engine like this one (see
+        _init_worker.) The build time is taken now, so all the workers use the same.
+        """
+        self.build_timestamp()
+
+        return dict((name, getattr(self, name)) for name in self.settings)
+
+    def source_dir(self, file_name):
+        return self.source_key(os.path.dirname(file_name) or '.')
+
+    def include_path(self, basepath, arg):
+        """
+        Returns the path of '//@include arg', in a file whose directory is 'basepath'.
+        """
+        return self.source_key('{base}/{arg}'.format(base=basepath, arg=arg))
+
+    def enable_stats(self, hook=None):
+        """
+        Turns on the stats (see ParseStats.) Each file parsed gets a record, which is passed to
+        'hook' (when given) and added to self.stats. With stats off, the engine only pays for a
+        few checks per file.
+
+        @param    hook    Function    Called with the ParseStats of each file, as soon as it's parsed.
+        """
+        self.stats = ParseStats()
+        self.stats_hook = hook
+
+    def begin_file_stats(self, file_name):
+        """
+        Starts the stats record for a file, unless stats are off or a record is already open (e.g.
+        for the file including this one.) Returns True if a record was started.
+        """
+        if self.stats is None or self.file_stats is not None:
+            return False
+
+        self.file_stats = ParseStats(file_name)
+        self.file_stats.files = 1
+        self.file_stats.cache_hits = -self.include_cache_hits
+        self.file_stats.cache_misses = -self.include_cache_misses
+
+        return True
+
+    def end_file_stats(self):
+        """
+        Closes (and returns) the record started by begin_file_stats().
+        """
+        stats = self.file_stats
+        self.file_stats = None
+
+        stats.cache_hits += self.include_cache_hits
+        stats.cache_misses += self.include_cache_misses
+
+        return stats
+
+    def record_stats(self, stats):
+        """
+        Adds a file's record to the totals, and passes it to the hook.
+        """
+        # The totals may be shared by the engines spawn()ed for other threads.
+        with _stats_lock:
+            self.stats.add(stats)
+
+            if self.stats_hook is not None:
+                self.stats_hook(stats)
+
+    def enter_include(self):
+        """
+        Called before processing an include. Returns the time, for leave_include().
+        """
+        stats = self.file_stats
+        if stats is None:
+            return None
+
+        stats.include_depth = max(stats.include_depth, len(self._include_stack))
+        stats.nested += 1
+
+        return timer()
+
+    def leave_include(self, started):
+        stats = self.file_stats
+        if stats is not None:
+            stats.nested -= 1
+            stats.lap('include', started)
+
+    def clear_caches(self):
+        """
+        Forgets the compiled files and rendered includes. The caches are meant to last for a
+        single run (e.g. one scan_and_parse_dir), as they don't notice files changing on disk.
+        """
+        self.compile_cache = {}
+        self.include_cache = {}
+        self.include_cache_hits = 0
+        self.include_cache_misses = 0
+        self._once_includes = []  # (path, output) of each //@include_once marked by do_include().
+        self._once_index = {}
+
+    def reset(self, env=None):
+        """
+        Clears the state left by parsing. The env starts empty, or as a copy of 'env' when given.
+        """
+        self.env = {} if env is None else dict(env)
+        self.included_once = set()
+        self.inline_functions = {}
+        self._location = None
+        self.file_stats = None
+
+    def warn(self, message, location=None):
+        """
+        Prints a warning about the source being parsed, prefixed with the file:line of the macro
+        being handled (when it's known), to self.warnings or else sys.stdout (which the test runner
+        and the -j workers collect.)
+        """
+        location = location or self._location
+        if location:
+            message = "{l}: {m}".format(l=location, m=message)
+
+        (self.warnings or sys.stdout).write("  Error: {m}\n".format(m=message))
+
+    def do_define(self, key, value=DEFINE_DEFAULT):
+        if key in self.env:
+            return
+
+        self.env[key] = self.eval_define(value)
+
+    def eval_define(self, value):
+        """
+        Evaluates the value of a //@define (or --def) as an Expression, which may use the
+        variables defined before it.
+        """
+        try:
+            return Expression.compile(value.strip())(self.env.__getitem__)
+
+        except KeyError as err:
+            raise MacroError("{k} is not defined (in the value '{v}')".format(k=err.args[0], v=value.strip()))
+
+    def split_cmdline_define(self, spec):
+        """
+        Splits a command-line 'VAR[=VALUE]' into a (key, value) pair.
+        """
+        res = self.re_define_cmdline_macro.match(spec)
+        if res:
+            return res.group(1), res.group(2)
+
+        return spec, DEFINE_DEFAULT
+
+    def do_include(self, mo):
+        """
+        Used to include an external (JavaScript) file.
+        """
+        arg = mo.group(3).strip()
+        path = self.include_path(self._basepath, arg)
+
+        # The regex engine can't tell which variables the file uses, so they're all part of the key.
+        key = (path, tuple(sorted((k, repr(v)) for k, v in self.env.items())))
+
+        # open the file (relative to the src file we're working with)
+        # run the parser over it
+        # return the output
+        self.check_include(path, self._include_stack[-1])
+
+        basepath = self._basepath
+        started = self.enter_include()
+        try:
+            text = self.cached_include(key, lambda: self.parse(path))
+
+            # The blocks haven't been expanded yet, so whether an //@include_once is output is left to resolve_once().
+            if mo.group(2):
+                index = self._once_index.get(key)
+                if index is None:
+                    index = self._once_index[key] = len(self._once_includes)
+                    self._once_includes.append((path, text))
+
+                return "{m}{i}{m}".format(m=ONCE_MARK, i=index)
+
+            return text
+
+        except (IOError, OSError) as err:
+            raise MacroError("{l}: unable to include {p} ({e})".format(l=self._include_stack[-1], p=path, e=err))
+
+        finally:
+            self._basepath = basepath
+            self.leave_include(started)
+
+    def resolve_once(self, text):
+        """
+        Replaces the marks do_include() left for the //@include_once files (in the branches that
+        were output) with the file's output the first time the file appears, and with nothing after
+        that.
+        """
+        def resolve(mo):
+            path, included = self._once_includes[int(mo.group(1))]
+
+            if path in self.included_once:
+                return COMPACT_MARK if self.compact else ''
+
+            self.included_once.add(path)
+
+            return self.re_once_mark.sub(resolve, included)
+
+        return self.re_once_mark.sub(resolve, text)
+
+    def cached_include(self, key, render):
+        """
+        Returns the output of an included file from the include cache, or from 'render' on a miss.
+        Along with the output, the cache keeps the variables the file added to the env (with
+        //@define), the files it added with //@include_once, and the functions it added with
+        //@inline, so that a hit leaves the engine just as rendering it would have.
+
+        @param    key       Tuple       The real path of the file, and the env values its output depends on.
+        @param    render    Function    Outputs the file.
+        """
+        cached = self.include_cache.get(key)
+
+        if cached is None:
+            self.include_cache_misses += 1
+            before = set(self.env)
+            before_once = set(self.included_once)
+            before_inline = dict(self.inline_functions)
+            text = render()
+            cached = (text, dict((k, v) for k, v in self.env.items() if k not in before), self.included_once - before_once,
+                      dict((k, v) for k, v in self.inline_functions.items() if before_inline.get(k) is not v))
+            self.include_cache[key] = cached
+
+        else:
+            self.include_cache_hits += 1
+            self.env.update(cached[1])
+            self.included_once.update(cached[2])
+            self.inline_functions.update(cached[3])
+
+        return cached[0]
+
+    def check_include(self, path, location):
+        """
+        Raises a MacroError if 'path' is already being parsed, i.e. if including it would never end.
+        """
+        if path in self._include_stack:
+            chain = self._include_stack[self._include_stack.index(path):] + [path]
+            raise MacroError("{l}: circular //@include ({c})".format(l=location, c=" -> ".join(chain)))
+
+    def test_if(self, arg):
+        """
+        Returns True or False based on the value of the expression 'arg' in the env dictionary, or
+        None if it uses a variable that isn't defined (in which case the block should be left
+        unmodified.)
+
+        @param    arg    String    Statement found after the 'if'. An Expression, e.g. 'DEBUG && !IE6'.
+        """
+        try:
+            return bool(Expression.compile(arg)(self.env.__getitem__))
+
+        except KeyError as err:
+            self.warn("{a} is not defined, using unmodified block.".format(a=err.args[0]))
+
+        except MacroError as err:
+            self.warn("{e}, using unmodified block.".format(e=err))
+
+        return None
+
+    def test_ifdef(self, arg):
+        """
+        An ifdef is true if the variable 'arg' exists in the environment, regardless of whether
+        it resolves to True or False. 'arg' can also be an Expression, in which each variable
+        stands for whether it's defined, e.g. 'FOO || BAR'.
+        """
+        try:
+            return bool(Expression.compile(arg)(lambda name: name in self.env))
+
+        except MacroError as err:
+            self.warn("{e}, using unmodified block.".format(e=err))
+
+        return None
+
+    def test_ifndef(self, arg):
+        """
+        An ifndef is true if 'arg' (as for an ifdef) is false.
+        """
+        result = self.test_ifdef(arg)
+
+        if result is None:
+            return None
+
+        return not result
+
+    def select_branch(self, result, parts, text):
+        """
+        Picks the text to output for a conditional macro.
+
+        @param    result    Boolean   The outcome of the test, or None to output 'text' unmodified.
+        @param    parts     List      The text found before and after the '//@else' statement.
+        @param    text      String    The text found between the macro statements
+        """
+        if result is None:
+            return "{s}".format(s=text)
+
+        if result:
+            return "{s}".format(s=parts[0])
+
+        try:
+            return "{s}".format(s=parts[1])
+
+        except IndexError:
+            return ''
+
+    def handle_if(self, arg, text):
+        """
+        Returns the text to output based on the value of 'arg'.  E.g., if arg evaluates to false,
+        expect to get an empty string back.
+
+        @param    arg    String    Statement found after the 'if'. Currently expected to be a variable (i.e., key) in the env dictionary.
+        @param    text   String    The text found between the macro statements
+        """
+        # To handle the '//@else' statement, we'll split text on the statement.
+        return self.select_branch(self.test_if(arg), re.split(self.re_else_pattern, text), text)
+
+    def handle_ifdef(self, arg, text):
+        """
+        @param    arg    String    Statement found after the 'ifdef'. Currently expected to be a variable (i.e., key) in the env dictionary.
+        @param    text   String    The text found between the macro statements
+        """
+        return self.select_branch(self.test_ifdef(arg), re.split(self.re_else_pattern, text), text)
+
+    def handle_ifndef(self, arg, text):
+        """
+        @param    arg    String    Statement found after the 'ifndef'. Currently expected to be a variable (i.e., key) in the env dictionary.
+        @param    text   String    The text found between the macro statements
+        """
+        return self.select_branch(self.test_ifndef(arg), re.split(self.re_else_pattern, text), text)
+
+    # The attributes get_settings() copies to the engines of worker processes.
+    settings = ('engine', 'save_failure_output', 'replace_defines', 'compact', 'srcdir', 'build_time', 'block_macros', 'line_macros')
+
+    # The names after '//@' that aren't block macros, but aren't unknown either.
+    known_macros = frozenset(['define', 'include', 'strip', 'else', 'end', 'endif', 'endifdef', 'endifndef'])
+
+    # The parts of JavaScript that replace_tokens() leaves alone: comments, and string and template literals.
+    re_replace_skip = "//[^\n]*|/\\*.*?\\*/|'(?:\\\\.|[^'\\\\\n])*'|\"(?:\\\\.|[^\"\\\\\n])*\"|`(?:\\\\.|[^`\\\\])*`"
+
+    # Finds the brackets outside of the parts replace_tokens() skips, for property_context().
+    re_replace_brackets = re.compile("({s})|([{{}}\\[\\]()])".format(s=re_replace_skip), re.S)
+
+    # The ${...} substitutions of a template literal, which replace_tokens() does look into (unless they hold braces.)
+    re_template_sub = re.compile("\\$\\{([^{}`]*)\\}")
+
+    # (matcher, replacements) for each env replace_tokens() has seen, shared by all engines.
+    _replacers = {}
+
+    def js_literal(self, value):
+        """
+        Returns a define's value as a JavaScript literal.
+        """
+        if value is None or isinstance(value, bool):
+            return {None: 'null', True: 'true', False: 'false'}[value]
+
+        if isinstance(value, (int, float)):
+            return repr(value)
+
+        return json.dumps(value)
+
+    def replacer(self):
+        """
+        Returns the (matcher, replacements) pair for the current env. The matcher is a single regex,
+        an alternation of the parts to skip and of every defined name, so a file is scanned once
+        however many names are defined. It is built once per env (by its names and values.)
+        """
+        key = tuple(sorted((k, repr(v)) for k, v in self.env.items()))
+        replacer = self._replacers.get(key)
+
+        if replacer is None:
+            replacements = dict((k, self.js_literal(v)) for k, v in self.env.items())
+
+            # Longest first, so a name is never cut short by another that starts it.
+            names = "|".join(re.escape(k) for k in sorted(replacements, key=lambda k: (-len(k), k)))
+            matcher = re.compile("({s})|(?<![\\w$.])({n})(?![\\w$])".format(s=self.re_replace_skip, n=names), re.S)
+
+            replacer = (matcher, replacements)
+            self._replacers[key] = replacer
+
+        return replacer
+
+    def replace_tokens(self, text):
+        """
+        Replaces each identifier that names a defined variable with the variable's value (as a
+        JavaScript literal), e.g. 'API_URL' with '"https://example.com"'. Comments, strings,
+        property names after a '.', and the keys of object literals are left alone, and a shorthand
+        property ('{API_URL}') keeps its name as the key ('{API_URL: "https://example.com"}'.) In a
+        template literal, only the ${...} substitutions are looked into.
+
+        (Regular expression literals aren't recognized, so a defined name inside one is replaced,
+        and a substitution holding braces or a nested template literal is left alone.)
+        """
+        if not self.env:
+            return text
+
+        matcher, replacements = self.replacer()
+        brackets = {'pos': 0, 'open': []}  # The brackets open at 'pos', found by property_context() as needed.
+
+        def replace(mo):
+            skipped = mo.group(1)
+            if skipped is not None:
+                if skipped.startswith('`') and '${' in skipped:
+                    return self.re_template_sub.sub(lambda sub: "${" + self.replace_tokens(sub.group(1)) + "}", skipped)
+
+                return skipped
+
+            name = mo.group(2)
+            context = self.property_context(text, mo.start(2), mo.end(2), brackets)
+
+            if context == 'key':
+                return name
+
+            if context == 'shorthand':
+                return "{n}: {v}".format(n=name, v=replacements[name])
+
+            return replacements[name]
+
+        return matcher.sub(replace, text)
+
+    def property_context(self, text, start, end, brackets):
+        """
+        Returns 'key' if the name at text[start:end] is the key of a property in an object literal
+        ('{NAME: value}'), 'shorthand' if it's a shorthand property ('{a, NAME}'), or None. That's
+        mostly told by the characters around it; only for ', NAME,' are the brackets open at
+        'start' needed. They're tracked in 'brackets' from where the last call left off, so a text
+        is only scanned for them once.
+        """
+        before = start - 1
+        while before >= 0 and text[before] in ' \t\r\n':
+            before -= 1
+
+        after = end
+        while after < len(text) and text[after] in ' \t\r\n':
+            after += 1
+
+        if before < 0 or text[before] not in '{,' or after == len(text) or text[after] not in ':,}':
+            return None
+
+        if text[after] == ':':
+            return 'key'
+
+        if text[before] == '{' or text[after] == '}':
+            return 'shorthand'
+
+        opened = brackets['open']
+        for mo in self.re_replace_brackets.finditer(text, brackets['pos'], start):
+            if mo.group(2) is None:
+                continue
+
+            if mo.group(2) in '{[(':
+                opened.append(mo.group(2))
+            elif opened:
+                opened.pop()
+
+        brackets['pos'] = start
+
+        return 'shorthand' if opened and opened[-1] == '{' else None
+
+
+    def handle_inline(self, arg, text):
+        """
+        Records the functions defined between //@inline and //@end, so that the calls to them can be
+        replaced with their bodies (see inline_calls().) The definitions are output unmodified.
+
+        A function can be inlined if its parameters are plain names, and its body is a single return
+        statement that doesn't use 'this', 'arguments', or the function itself.
+
+        @param    arg    String    The names of the functions to inline, separated by spaces or commas (all of them by default.)
+        @param    text   String    The text found between the macro statements
+        """
+        wanted = set(re.findall("[\\w$]+", arg))
+        found = set()
+
+        for mo in self.re_inline_function.finditer(text):
+            name = mo.group(1) or mo.group(2)
+            if wanted and name not in wanted:
+                continue
+
+            found.add(name)
+
+            close = self.match_bracket(text, mo.end() - 1)
+            if close < 0:
+                self.warn("can't inline {n}(), its body isn't closed.".format(n=name))
+                continue
+
+            params = [param.strip() for param in mo.group(3).split(',')] if mo.group(3).strip() else []
+            if not all(re.match("[A-Za-z_$][\\w$]*$", param) for param in params):
+                self.warn("can't inline {n}(), only plain parameters are supported.".format(n=name))
+                continue
+
+            # Comments go, but strings have to stay as they are.
+            body = self.re_js_skip.sub(lambda m: ' ' if m.group(0)[0] == '/' else m.group(0), text[mo.end():close])
+            ret = self.re_inline_return.match(body)
+            code = self.re_js_skip.sub('""', ret.group(1)) if ret else ''
+
+            if not code.strip() or ';' in code:
+                self.warn("can't inline {n}(), its body isn't a single return statement.".format(n=name))
+                continue
+
+            if re.search("(?<![\\w$.])(this|arguments|{n})(?![\\w$])".format(n=re.escape(name)), code):
+                self.warn("can't inline {n}(), it uses 'this', 'arguments' or itself.".format(n=name))
+                continue
+
+            self.inline_functions[name] = _InlineFunction(name, params, ret.group(1).strip(), self._location)
+
+        if not found:
+            self.warn("//@inline without a function definition{s}.".format(s=" for " + ", ".join(sorted(wanted)) if wanted else ""))
+
+        elif wanted - found:
+            self.warn("//@inline didn't find a definition for {n}.".format(n=", ".join(sorted(wanted - found))))
+
+        return text
+
+    def match_bracket(self, text, pos):
+        """
+        Returns the index of the bracket that closes the one at text[pos], or -1 if it isn't closed.
+        Brackets in comments and strings don't count.
+        """
+        depth = 0
+        length = len(text)
+
+        while pos < length:
+            c = text[pos]
+
+            if c in "([{":
+                depth += 1
+
+            elif c in ")]}":
+                depth -= 1
+                if not depth:
+                    return pos
+
+            elif c in "/'\"`":
+                mo = self.re_js_skip.match(text, pos)
+                if mo:
+                    pos = mo.end()
+                    continue
+
+            pos += 1
+
+        return -1
+
+    def split_arguments(self, text):
+        """
+        Splits the arguments of a call (the text between its brackets) at the commas that aren't
+        nested in brackets, comments or strings.
+        """
+        if not text.strip():
+            return []
+
+        args = []
+        depth = 0
+        start = pos = 0
+        length = len(text)
+
+        while pos < length:
+            c = text[pos]
+
+            if c in "([{":
+                depth += 1
+
+            elif c in ")]}":
+                depth -= 1
+
+            elif c == ',' and not depth:
+                args.append(text[start:pos].strip())
+                start = pos + 1
+
+            elif c in "/'\"`":
+                mo = self.re_js_skip.match(text, pos)
+                if mo:
+                    pos = mo.end()
+                    continue
+
+            pos += 1
+
+        args.append(text[start:].strip())
+
+        return args
+
+    def inline_calls(self, text, location=None, active=()):
+        """
+        Replaces the calls to the //@inline functions with their bodies, in brackets, with the
+        arguments substituted for the parameters. Calls in comments and strings, method calls and
+        the definitions themselves are left alone.
+
+        A call is left unmodified, with a warning, if it doesn't pass one argument per parameter, or
+        if inlining it could change when its arguments are evaluated: an argument that isn't a
+        name, a number or a plain string has to be used exactly once by the body, and in the order
+        of the parameters. (The body's names are not renamed, so a call shouldn't be inlined where
+        a local variable hides a name the body uses.)
+
+        @param    text        String    The output to inline the calls in.
+        @param    location    String    Where the output came from, for the warnings.
+        @param    active      Tuple     The functions being inlined, which aren't inlined again (in case they call each other.)
+        """
+        names = [name for name in self.inline_functions if name not in active]
+        if not names:
+            return text
+
+        names = "|".join(re.escape(name) for name in sorted(names, key=lambda name: (-len(name), name)))
+        matcher = re.compile("({s})|(?<![\\w$.])({n})[\\t ]*\\(".format(s=self.re_replace_skip, n=names), re.S)
+
+        out = []
+        pos = 0
+
+        while True:
+            mo = matcher.search(text, pos)
+            if mo is None:
+                break
+
+            out.append(text[pos:mo.start()])
+            pos = mo.end()
+
+            close = -1 if mo.group(1) else self.match_bracket(text, mo.end() - 1)
+            after = text[close + 1:close + 64].lstrip()
+
+            # A comment or string, an unclosed call, a definition ('function name(...) {') or a method ('name(...) {'.)
+            if close < 0 or after.startswith('{') or re.search("(?:^|[^\\w$])function[\\t ]+$", text[max(0, mo.start() - 32):mo.start()]):
+                out.append(mo.group(0))
+                continue
+
+            # The calls in the arguments are inlined first, whether or not this one can be.
+            inner = self.inline_calls(text[mo.end():close], location, active)
+            expansion = self.expand_inline(self.inline_functions[mo.group(2)], self.split_arguments(inner), location, active)
+
+            out.append(mo.group(0) + inner + ')' if expansion is None else expansion)
+            pos = close + 1
+
+        out.append(text[pos:])
+
+        return ''.join(out)
+
+    def expand_inline(self, function, args, location, active):
+        """
+        Returns the code replacing a call to an //@inline function, or None (after a warning) if the
+        call can't be inlined. See inline_calls().
+
+        Arguments that are names (or properties, like 'a.b' or 'a[i]'), numbers or plain strings can
+        be used any number of times. Any other argument (or a negative number) is put in brackets.
+        """
+        call = "{n}({a})".format(n=function.name, a=", ".join(" ".join(arg.split()) for arg in args))
+        if len(call) > 60:
+            call = call[:56] + "...)"
+
+        if len(args) != len(function.params):
+            self.warn("can't inline {c}, {n}() takes {p} argument{s}.".format(
+                c=call, n=function.name, p=len(function.params), s='' if len(function.params) == 1 else 's'), location)
+            return None
+
+        if any(arg.startswith('...') for arg in args):
+            self.warn("can't inline {c}, it spreads its arguments.".format(c=call), location)
+            return None
+
+        # The calls the body makes to other //@inline functions come first, so their parameters count too.
+        body = self.inline_calls(function.body, location, active + (function.name,))
+        uses = [m.group(2) for m in function.re_param.finditer(body) if m.group(2)]
+
+        values = {}
+        order = []
+        for param, arg in zip(function.params, args):
+            if self.re_inline_simple.match(arg):
+                values[param] = "({a})".format(a=arg) if arg.startswith('-') else arg
+                continue
+
+            if uses.count(param) != 1:
+                self.warn("can't inline {c}, '{a}' would be evaluated {n} times.".format(c=call, a=" ".join(arg.split()), n=uses.count(param)), location)
+                return None
+
+            values[param] = "({a})".format(a=arg)
+            order.append(param)
+
+        if [param for param in uses if param in order] != order:
+            self.warn("can't inline {c}, its arguments would be evaluated out of order.".format(c=call), location)
+            return None
+
+        return "({b})".format(b=function.re_param.sub(lambda m: m.group(1) or values[m.group(2)], body))
+
+    def register_methods(self):
+        """
+        Registers a block macro for each 'handle_NAME' method of the engine's class (with its
+        'test_NAME' method, if any.) This is how the built-in macros, and those of subclasses, get
+        into the dispatch table.
+        """
+        cls = self.__class__
+
+        for attr in dir(cls):
+            if attr.startswith('handle_') and attr != 'handle_macro':
+                name = attr[len('handle_'):]
+                self.register_block(name, getattr(cls, attr), getattr(cls, "test_{m}".format(m=name), None))
+
+    def register_block(self, name, handler, test=None):
+        """
+        Adds (or replaces) the wrapped macro '//@name ARG ... //@end'.
+
+        @param    name       String      The macro's name, in lower case letters.
+        @param    handler    Function    Called as handler(engine, arg, text), returns the text to output in place of the block.
+        @param    test       Function    Optional. For a conditional macro, called as test(engine, arg), returns True to output the
+                                         text before the //@else, False for the text after it, or None to leave the block unmodified.
+                                         With the scan engine, only the branch picked is rendered.
+        """
+        if not re.match("[a-z]+$", name) or name in self.known_macros or name in self.line_macros:
+            raise MacroError("can't register a block macro named '{n}'".format(n=name))
+
+        self.block_macros[name] = (handler, test)
+
+    def register_line(self, name, handler, pattern=None):
+        """
+        Adds (or replaces) the line macro '//@name ARG', which is replaced (up to the end of its line,
+        but not the line break) with the output of its handler.
+
+        @param    name       String      The macro's name.
+        @param    handler    Function    Called as handler(engine, arg), returns the text to output in place of the macro.
+        @param    pattern    Regex       Optional. A compiled pattern to find the macro with, instead of '//@name ARG'. Its first
+                                         group (if it has one) is the 'arg' passed to the handler. It is also searched for in
+                                         whole files (see line_markers), so '^' and '$' need re.M.
+        """
+        if name in self.known_macros or name in self.block_macros:
+            raise MacroError("can't register a line macro named '{n}'".format(n=name))
+
+        if pattern is None:
+            pattern = re.compile("//[@#]{n}(?![\\w$])[\t ]*([^\r\n]*?)[\t ]*(?=\r?$)".format(n=re.escape(name)), re.M)
+
+        self.line_macros[name] = (pattern, handler)
+
+    def line_markers(self):
+        """
+        Returns the patterns of the line macros that re_scan_marker wouldn't find (the ones
+        registered with a pattern that doesn't start with '//@'), which the scan engine and
+        has_markers() look for as well.
+        """
+        return [pattern for pattern, handler in self.line_macros.values() if not pattern.pattern.startswith("//[@#]")]
+
+    def find_markers(self, text, line_markers):
+        """
+        Returns an iterator over the positions of the markers in text, in order: the matches of
+        re_scan_marker and of the line_markers() patterns, which are each searched for once.
+        """
+        patterns = [self.re_scan_marker] + line_markers
+
+        return heapq.merge(*[(mo.start() for mo in pattern.finditer(text)) for pattern in patterns])
+
+    def is_block_macro(self, name):
+        """
+        Returns True if '//@name' opens a wrapped macro, i.e. it's in the dispatch table.
+        """
+        return name in self.block_macros
+
+    def handle_macro(self, mo):
+        method = mo.group(2)
+        args = mo.group(3).strip()
+        code = mo.group(4)
+
+        macro = self.block_macros.get(method)
+        if macro is None:
+            self.warn("unknown macro //@{m}, leaving it unmodified.".format(m=method))
+            return mo.group(0)
+
+        if self.file_stats is not None:
+            self.file_stats.count(method)
+            self.file_stats.count('else', len(re.findall(self.re_else_pattern, code)))
+            self.file_stats.count('end')
+
+        return macro[0](self, args, code)
+
+    def parse(self, file_name, text=None):
+        """
+        Parses a file and returns the output.
+
+        @param    file_name    String    The name of the file, which its @__file__ and //@include paths are based on.
+        @param    text         String    The contents of the file. When not given, it is read with read_source().
+        """
+        owner = self.begin_file_stats(file_name)
+        started = timer()
+
+        # Save this for the @import implementation
+        self._basepath = self.source_dir(file_name)
+
+        if text is None:
+            text = self.read_source(file_name)
+
+        stats = self.file_stats
+        if stats is not None and not stats.nested:
+            stats.lap('read', started)
+            stats.bytes_in += len(text)
+
+        try:
+            if self.engine == ENGINE_REGEX:
+                self._include_stack.append(self.source_key(file_name))
+
+                try:
+                    text = self.parse_regex(text, file_name)
+
+                finally:
+                    self._include_stack.pop()
+
+            else:
+                text = self.parse_scan(text, file_name)
+
+        finally:
+            if owner:
+                stats = self.end_file_stats()
+
+        if owner:
+            stats.bytes_out += len(text)
+            self.record_stats(stats)
+
+        return text
+
+    def parse_regex(self, text, file_name):
+        """
+        The original engine. Runs each macro's regex over the full text, one after another.
+        """
+        now = self.build_timestamp()
+        stats = self.file_stats
+        started = timer()
+
+        # Replace supported __foo__ statements
+        # Start with __line__ because it needs the un-preprocessed line number.
+        index = LineIndex(text, file_name)
+        text, subs = self.re_line_sub_macro.subn(lambda mo: '{l}'.format(l=index.line(mo.start())), text)
+
+        if stats is not None:
+            stats.count('builtin', subs)
+            started = stats.lap('line', started)
+
+        # Now replace all other __foo__ statements.
+        subs = 0
+        text, n = self.re_file_sub_macro.subn('{f}'.format(f=self.source_name(file_name)), text)
+        subs += n
+        text, n = self.re_datetime_sub_macro.subn('{s}'.format(s=now.strftime("%b %d, %Y %I:%M%p")), text)
+        subs += n
+        text, n = self.re_time_sub_macro.subn('{s}'.format(s=now.strftime("%I:%M%p")), text)
+        subs += n
+        text, n = self.re_date_sub_macro.subn('{s}'.format(s=now.strftime("%b %d, %Y")), text)
+        subs += n
+
+        if stats is not None:
+            stats.count('builtin', subs)
+            started = stats.lap('builtins', started)
+
+        # Parse for DEFINE statements
+        for mo in self.re_define_macro.finditer(text):
+            if mo:
+                k = mo.group(2)  # key
+                v = mo.group(4)  # value
+
+                if v is None:
+                    v = DEFINE_DEFAULT
+
+                self.do_define(k, v)
+
+        if stats is not None:
+            stats.lap('define', started)
+
+        # Parse include statements
+        text, n = self.re_include_macro.subn(self.do_include, text)
+
+        if stats is not None:
+            stats.count('include', n)
+            started = timer()
+
+        # Delete the DEFINE statements
+        mark = COMPACT_MARK if self.compact else ''
+        text, n = self.re_define_macro.subn(mark, text)
+
+        if stats is not None:
+            stats.count('define', n)
+            started = stats.lap('define', started)
+
+        # Drop any lines containing a //@strip statement
+        text, n = self.re_stripline_macro.subn(mark, text)
+
+        if stats is not None:
+            stats.count('strip', n)
+            started = stats.lap('strip', started)
+
+        for name, (pattern, handler) in self.line_macros.items():
+            text, n = pattern.subn(lambda mo: mark + handler(self, (mo.group(1) or '').strip() if mo.groups() else ''), text)
+
+            if stats is not None:
+                stats.count(name, n)
+
+        if self.line_macros and stats is not None:
+            started = stats.lap('line_macros', started)
+
+        # Do the magic... (Line numbers are lost by now, so warnings only point at the file.)
+        self._location = file_name
+        if self.compact:
+            text = self.re_wrapped_macro.sub(lambda mo: mark + self.handle_macro(mo) + mark, text)
+        else:
+            text = self.re_wrapped_macro.sub(self.handle_macro, text)
+        self._location = None
+
+        if stats is not None:
+            stats.lap('wrapped', started)
+
+        if len(self._include_stack) == 1:
+            if ONCE_MARK in text:
+                text = self.resolve_once(text)
+
+            if self.inline_functions:
+                text = self.inline_calls(text, file_name)
+
+            if self.replace_defines:
+                text = self.replace_tokens(text)
+
+            if self.compact:
+                text = self.compact_output(text)
+
+        return text
+
+    def parse_scan(self, text, file_name):
+        """
+        The single-pass engine. The text is scanned once into a CompiledSource, which is then
+        rendered against the env.
+        """
+        return self.render(self.compile_text(text, file_name))
+
+    def compile(self, file_name):
+        """
+        Compiles a file for use with render(). A build that targets several environments can
+        compile each file once and render it as many times as it needs.
+
+        Included files are kept in the compile cache, so a file included by many others is only
+        read and scanned once per run. The files compiled at the top level aren't, so memory use
+        doesn't grow with the size of the tree.
+        """
+        compiled = self.compile_cache.get(file_name)
+
+        if compiled is None:
+            started = timer()
+            text = self.read_source(file_name)
+
+            stats = self.file_stats
+            if stats is not None and not stats.nested:
+                stats.lap('read', started)
+                stats.bytes_in += len(text)
+
+            compiled = self.compile_text(text, file_name)
+
+            if self._include_stack:
+                self.compile_cache[file_name] = compiled
+
+        return compiled
+
+    def compile_text(self, text, file_name):
+        started = timer()
+        compiled = self.scan(text, file_name)
+
+        if self.file_stats is not None:
+            self.file_stats.lap('scan', started)
+
+        self._include_stack.append(self.source_key(file_name))
+
+        try:
+            self.compile_includes(compiled)
+
+        finally:
+            self._include_stack.pop()
+
+        return compiled
+
+    def compile_includes(self, compiled):
+        for include in compiled.includes:
+            if include.compiled is not None:
+                continue
+
+            self.check_include(include.path, include.location)
+
+            started = self.enter_include()
+            try:
+                include.compiled = self.compile(include.path)
+
+            except (IOError, OSError) as err:
+                raise MacroError("{l}: unable to include {p} ({e})".format(l=include.location, p=include.path, e=err))
+
+            finally:
+                self.leave_include(started)
+
+            compiled.names.update(include.compiled.names)
+
+    def scan(self, text, file_name):
+        """
+        Splits 'text' into plain text and macro lines, returning a CompiledSource whose includes
+        have not been compiled yet.
+        """
+        index = LineIndex(text, file_name)
+        scanner = _Scanner(self, file_name)
+
+        pos = 0
+        length = len(text)
+
+        # Only the line macros with patterns of their own need more than re_scan_marker.
+        markers = self.find_markers(text, scanner.line_markers) if scanner.line_markers else None
+
+        while pos < length:
+            if markers is None:
+                mo = self.re_scan_marker.search(text, pos)
+                marker = mo.start() if mo else -1
+            else:
+                marker = next((marker for marker in markers if marker >= pos), -1)
+
+            if marker < 0:
+                scanner.text(text[pos:])
+                break
+
+            # Pass everything up to the start of the marked line through untouched.
+            start = max(pos, text.rfind('\n', pos, marker) + 1)
+            if start > pos:
+                scanner.text(text[pos:start])
+
+            end = text.find('\n', marker)
+            end = length if end < 0 else end + 1
+
+            scanner.line(text[start:end], index.line(start))
+            pos = end
+
+        scanner.finish()
+
+        return scanner.compiled
+
+    def parse_stream(self, lines, file_name='-'):
+        """
+        Parses a source one line at a time (e.g. from a file object, or sys.stdin), yielding the
+        output as soon as it's known. Only the currently open wrapped macro is held in memory, so
+        memory use doesn't grow with the size of the input.
+
+        Unlike parse(), each //@define only applies from the line it's on, since the lines after it
+        haven't been read yet, and the calls to an //@inline function are only inlined after its
+        definition (and, outside of the blocks, only when the call fits on one line.) With replace_defines,
+        comments, strings and object literals spanning several lines aren't recognized as such.
+        """
+        scanner = _Scanner(self, file_name)
+        pending = scanner.compiled
+
+        self._include_stack.append(self.source_key(file_name))
+        owner = self.begin_file_stats(file_name)
+        stats = self.file_stats
+        started = timer()
+
+        try:
+            line_num = 0
+            for line in lines:
+                line_num += 1
+
+                if stats is not None:
+                    stats.bytes_in += len(line)
+
+                if self.re_scan_marker.search(line) is None and not any(marker.search(line) for marker in scanner.line_markers):
+                    if not scanner.blocks:
+                        if self.inline_functions:
+                            line = self.inline_calls(line, file_name)
+
+                        if self.replace_defines:
+                            line = self.replace_tokens(line)
+
+                        if stats is not None:
+                            stats.bytes_out += len(line)
+
+                        yield line
+                    else:
+                        scanner.text(line)
+
+                    continue
+
+                scanner.line(line, line_num)
+
+                if not scanner.blocks:
+                    text = self.flush_stream(pending)
+
+                    if stats is not None:
+                        stats.bytes_out += len(text)
+
+                    yield text
+
+            # Anything left is an unclosed block, which is output unmodified.
+            scanner.finish()
+            text = self.flush_stream(pending)
+
+            if stats is not None:
+                stats.bytes_out += len(text)
+
+            yield text
+
+        finally:
+            self._include_stack.pop()
+
+            if owner:
+                # The includes were already timed on their own.
+                stats.lap('stream', started + stats.seconds.get('include', 0.0))
+                self.record_stats(self.end_file_stats())
+
+    def flush_stream(self, pending):
+        """
+        Renders (and forgets) the tokens parse_stream() has collected so far.
+        """
+        self.compile_includes(pending)
+        text = self.render_compiled(pending)
+
+        if self.inline_functions:
+            text = self.inline_calls(text, pending.file_name)
+
+        if self.replace_defines:
+            text = self.replace_tokens(text)
+
+        if self.compact:
+            text = self.compact_output(text)
+
+        del pending.tokens[:]
+        del pending.defines[:]
+        del pending.includes[:]
+
+        return text
+
+    def render(self, compiled, env=None):
+        """
+        Outputs a CompiledSource. The work is done in the same order the regex engine uses:
+        defines first, then includes, then wrapped macros.
+
+        @param    compiled    CompiledSource    As returned by compile().
+        @param    env         Dictionary        Variables to render with. The file's //@define statements are added to a copy,
+                                                so the dictionary can be reused. When not given, self.env (and the files already
+                                                included with //@include_once, and the //@inline functions) are used, and updated.
+        """
+        started = timer()
+        saved_env = self.env
+        saved_once = self.included_once
+        saved_inline = self.inline_functions
+
+        if env is not None:
+            self.env = dict(env)
+            self.included_once = set()
+            self.inline_functions = {}
+
+        try:
+            text = self.render_compiled(compiled)
+
+            if self.inline_functions and not self._include_stack:
+                text = self.inline_calls(text, compiled.file_name)
+
+            if self.replace_defines and not self._include_stack:
+                text = self.replace_tokens(text)
+
+        finally:
+            self.env = saved_env
+            self.included_once = saved_once
+            self.inline_functions = saved_inline
+
+        if self.compact and not self._include_stack:
+            text = self.compact_output(text)
+
+        if self.file_stats is not None:
+            self.file_stats.lap('render', started)
+
+        return text
+
+    def render_compiled(self, compiled):
+        self.apply_defines(compiled)
+
+        return self.render_tokens(compiled.tokens)
+
+    def apply_defines(self, compiled):
+        """
+        Adds the //@define values of a file, and of the files it includes, to the env. As with the
+        regex engine, they all apply before any block is expanded, whichever branch they're in.
+        """
+        for key, value in compiled.defines:
+            self.do_define(key, value)
+
+        for include in compiled.includes:
+            self.apply_defines(include.compiled)
+
+    def render_include(self, include):
+        """
+        Outputs an //@include. It's only called for the includes in the branches that are output,
+        so an //@include_once in a branch that was removed doesn't count.
+        """
+        if include.once:
+            if include.path in self.included_once:
+                return COMPACT_MARK if self.compact else ''
+
+            self.included_once.add(include.path)
+
+        # The output of a file using //@include_once depends on which of those files were already included.
+        once = include.compiled.once_paths() & self.included_once
+        key = (include.path, tuple(sorted(relevant_env(include.compiled.names, self.env).items())), tuple(sorted(once)))
+
+        return self.cached_include(key, lambda: self.render_compiled(include.compiled))
+
+    def compact_output(self, text):
+        """
+        Takes the COMPACT_MARKs out of the output, along with the whitespace left over by the
+        macros removed there: a run of blank lines is collapsed to one if a macro was removed
+        within it, and a line that ended with a removed macro loses its trailing whitespace.
+        Whitespace away from the removed macros is left as it was in the source.
+        """
+        if COMPACT_MARK not in text:
+            return text
+
+        lines = text.split('\n')
+        out = []
+        blanks = []
+        marked_blanks = False
+
+        for n, line in enumerate(lines):
+            marked = COMPACT_MARK in line
+
+            if marked:
+                head, sep, tail = line.rpartition(COMPACT_MARK)
+                head = head.replace(COMPACT_MARK, '')
+
+                if not tail.strip():
+                    head = head.rstrip(' \t')
+
+                line = head + tail
+
+            # A blank line (but not the empty piece after the last newline.)
+            if not line.strip() and n < len(lines) - 1:
+                blanks.append(line)
+                marked_blanks = marked_blanks or marked
+                continue
+
+            out.extend(blanks[:1] if marked_blanks else blanks)
+            blanks = []
+            marked_blanks = False
+            out.append(line)
+
+        compacted = '\n'.join(out + (blanks[:1] if marked_blanks else blanks))
+
+        saved = len(text) - text.count(COMPACT_MARK) - len(compacted)
+        self.compact_saved += saved
+
+        if self.file_stats is not None:
+            self.file_stats.bytes_saved += saved
+
+        return compacted
+
+    def render_tokens(self, tokens):
+        """
+        Outputs a list of tokens. Nested blocks are expanded with a stack rather than by recursion,
+        so deep nesting doesn't run into Python's recursion limit.
+        """
+        out = []
+        stack = [iter(tokens)]
+
+        while stack:
+            for token in stack[-1]:
+                if isinstance(token, _Block):
+                    expansion = self.expand_block(token)
+
+                    # The opening and closing lines of a closed block are always removed.
+                    if self.compact and token.closed:
+                        expansion = [COMPACT_MARK] + expansion + [COMPACT_MARK]
+
+                    stack.append(iter(expansion))
+                    break
+
+                elif isinstance(token, _Include):
+                    out.append(self.render_include(token))
+
+                elif isinstance(token, _LineMacro):
+                    self._location = token.location
+                    try:
+                        out.append(self.line_macros[token.name][1](self, token.arg))
+
+                    finally:
+                        self._location = None
+
+                else:
+                    out.append(token)
+
+            else:
+                stack.pop()
+
+        return ''.join(out)
+
+    def expand_block(self, block):
+        """
+        Returns the tokens to output for a block. For conditionals, only the chosen branch is
+        output (so the blocks nested in the other branches are never evaluated.)
+        """
+        # The block as it was found, minus the opening and closing lines.
+        unmodified = list(block.branches[0])
+        for separator, branch in zip(block.separators, block.branches[1:]):
+            unmodified.append(separator)
+            unmodified.extend(branch)
+
+        # Without an //@end, the block is left as it was found.
+        if not block.closed:
+            return [block.opener] + unmodified
+
+        handler, test = self.block_macros[block.name]
+
+        self._location = block.location
+        try:
+            if test is None:
+                return [handler(self, block.arg, self.render_tokens(unmodified))]
+
+            result = test(self, block.arg)
+
+        finally:
+            self._location = None
+
+        if result is None:
+            return unmodified
+
+        if result:
+            return block.branches[0]
+
+        if len(block.branches) > 1:
+            return block.branches[1]
+
+        return []
+
+
+def epoch_datetime(seconds, source='--timestamp'):
+    """
+    Returns the (UTC) datetime for a number of seconds since the epoch, as given in 'source'.
+    """
+    try:
+        return datetime(1970, 1, 1) + timedelta(seconds=int(seconds))
+
+    except (ValueError, OverflowError):
+        raise MacroError("{s} must be a number of seconds since the epoch, not '{v}'".format(s=source, v=seconds))
+
+
+def walk_source_files(srcdir, excludes):
+    """
+    Yields a (dir, filename) pair for each file under srcdir, where dir is relative to srcdir
+    (using '/' separators.) Files in the excluded dirs are skipped.
+    """
+    for root, dirs, files in os.walk(srcdir):
+        # Walk in sorted order, so the files are always processed (and logged) in the same order.
+        dirs.sort()
+
+        dir = root[len(srcdir) + 1:]
+        dir = dir.replace("\\","/")     # slash works just as well for Windows.
+
+        # check if the dir is in excludes
+        skip = False
+        for e in excludes:
+            if dir == e or dir.startswith(e + "/"):
+                skip = True
+                break
+        
+        if skip:
+            continue
+
+        for filename in sorted(files):
+            yield dir, filename
+
+
+def join_path(base, dir, filename=None):
+    path = base
+    if dir != "":
+        path = "{b}/{d}".format(b=base, d=dir)
+
+    if filename is not None:
+        path = "{p}/{f}".format(p=path, f=filename)
+
+    return path
+
+
+def parse_variant(spec, parser):
+    """
+    Turns a --variant value of the form NAME[:VAR[=VALUE],...] into a (name, env) pair. The env
+    starts as a copy of the parser's env (i.e., the --def values) and the variant's values win.
+    """
+    name, sep, defines = spec.partition(':')
+    env = dict(parser.env)
+
+    for define in defines.split(','):
+        if define:
+            key, value = parser.split_cmdline_define(define)
+            env[key] = parser.eval_define(value)
+
+    return name, env
+
+
+def fast_copy(src, dst):
+    """
+    Copies the contents and permissions of src to dst, and returns the number of bytes copied.
+    Where the platform has os.sendfile(), the data is copied by the kernel without passing
+    through Python.
+    """
+    # Never write through an existing dst, which may be a link to src (or to another output.)
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    copied = 0
+    fsrc = open(src, 'rb')
+
+    try:
+        fdst = open(dst, 'wb')
+
+        try:
+            sendfile = getattr(os, 'sendfile', None)
+
+            try:
+                while sendfile is not None:
+                    sent = sendfile(fdst.fileno(), fsrc.fileno(), copied, COPY_CHUNK_SIZE)
+                    if sent == 0:
+                        break
+
+                    copied += sent
+
+            except OSError:
+                # Not supported for these files; carry on from where the kernel stopped.
+                sendfile = None
+
+            if sendfile is None:
+                fsrc.seek(copied)
+
+                while True:
+                    data = fsrc.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+
+                    fdst.write(data)
+                    copied += len(data)
+
+        finally:
+            fdst.close()
+
+    finally:
+        fsrc.close()
+
+    shutil.copymode(src, dst)
+
+    return copied
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-links dst to src, falling back to a copy where links aren't supported. Returns the number
+    of bytes copied (0 for a link.)
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+        return 0
+
+    except (AttributeError, OSError):
+        return fast_copy(src, dst)
+
+
+def write_output(out_file_path, data):
+    """
+    Writes data to a new out_file_path. An existing file is removed first rather than written
+    through, as it may be a link to a source file or to another output (see link_or_copy.)
+    """
+    if os.path.lexists(out_file_path):
+        os.remove(out_file_path)
+
+    outfile = open(out_file_path, 'w')
+    outfile.write(data)
+    outfile.close()
+
+
+def is_same_asset(src, dst, strategy):
+    """
+    Returns True if dst is already what 'strategy' would make of src, in which case it can be left
+    alone.
+    """
+    try:
+        if strategy == ASSET_SYMLINK:
+            return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+
+        if strategy == ASSET_HARDLINK:
+            return os.path.samefile(src, dst)
+
+        if strategy == ASSET_UPDATE:
+            src_stat = os.stat(src)
+            dst_stat = os.lstat(dst)
+
+            return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+    except (AttributeError, OSError):
+        pass
+
+    return False
+
+
+def install_asset(src, dst, strategy):
+    """
+    Puts the (non-js) file src at dst, and returns the number of bytes copied, or None if dst was
+    already up to date.
+
+    @param    strategy    String    One of ASSET_STRATEGIES. 'update' copies src along with its mtime, so
+                                    the next run can skip it if its size and mtime haven't changed.
+    """
+    if is_same_asset(src, dst, strategy):
+        return None
+
+    if strategy == ASSET_SYMLINK:
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return 0
+
+        except (AttributeError, NotImplementedError, OSError):
+            return fast_copy(src, dst)
+
+    if strategy == ASSET_HARDLINK:
+        return link_or_copy(src, dst)
+
+    copied = fast_copy(src, dst)
+
+    if strategy == ASSET_UPDATE:
+        shutil.copystat(src, dst)
+
+    return copied
+
+
+def process_source_file(parser, seed_env, in_file_path, outputs, track=False, assets=ASSET_UPDATE):
+    """
+    Processes one of the files found by scan_and_parse_dir, and returns a dict saying whether it
+    was 'parsed' (rather than copied.) With 'track', the dict also lists the define 'names' and the
+    'includes' the file depends on. For the other files, it gives the number of bytes 'copied' and
+    the number of outputs that were already 'unchanged'.
+
+    Every file is parsed starting from a copy of seed_env (the --def values), so the defines in
+    one file never leak into another. That keeps the output independent of the order the files
+    are processed in, and of which process handles them.
+
+    @param    outputs    List    (env, out_file_path) pairs. An env of None means a single output parsed with
+                                 the parser's engine; otherwise the file is compiled once and rendered for each env.
+    @param    assets     String  How non-js files are put in the outputs (one of ASSET_STRATEGIES.)
+    """
+    if not(in_file_path.endswith('.js')):
+        # Copy non-js files to the output dir, even though we're not going to process them.  This is useful in
+        # production environments where you might have other needed media files mixed-in with your JavaScript.
+        # With several outputs, the file is copied once and linked into the others.
+        copied = 0
+        unchanged = 0
+        source = in_file_path
+
+        for env, out_file_path in outputs:
+            result = install_asset(source, out_file_path, assets)
+
+            if result is None:
+                unchanged += 1
+            elif assets in (ASSET_HARDLINK, ASSET_SYMLINK) or source != in_file_path:
+                print("Linking {i} -> {o}".format(i=source, o=out_file_path))
+            else:
+                print("Copying {i} -> {o}".format(i=source, o=out_file_path))
+
+            copied += result or 0
+
+            if assets in (ASSET_UPDATE, ASSET_COPY):
+                source = out_file_path
+                assets = ASSET_HARDLINK
+
+        return {'parsed': False, 'copied': copied, 'unchanged': unchanged}
+
+    parser.reset(seed_env)
+    parser.include_cache_hits = 0
+    parser.include_cache_misses = 0
+    parser.begin_file_stats(in_file_path)
+
+    # A file without any macros is copied byte for byte (line endings and encoding included), without being decoded.
+    # (Unless it may use defined names that are to be replaced.)
+    started = timer()
+    replacing = parser.replace_defines and any(seed_env if env is None else env for env, out_file_path in outputs)
+    if not replacing and not parser.has_markers(in_file_path):
+        first = outputs[0][1]
+        size = fast_copy(in_file_path, first)
+        print(("Passing {i} -> {o} (no macros)".format(i=in_file_path, o=first)))
+
+        for env, out_file_path in outputs[1:]:
+            link_or_copy(first, out_file_path)
+            print(("Linking {i} -> {o}".format(i=first, o=out_file_path)))
+
+        result = {'parsed': True, 'passthrough': True, 'hits': 0, 'misses': 0}
+        if track:
+            result['names'] = None if parser.replace_defines else []
+            result['includes'] = []
+
+        if parser.file_stats is not None:
+            parser.file_stats.lap('passthrough', started)
+            parser.file_stats.bytes_in += size
+            parser.file_stats.bytes_out += size * len(outputs)
+            result['stats'] = parser.end_file_stats()
+
+        return result
+
+    # The regex engine has no compiled form, so it only compiles when the dependencies are needed.
+    single = outputs[0][0] is None
+    compiled = None
+    if track or not single or parser.engine != ENGINE_REGEX:
+        compiled = parser.compile(in_file_path)
+
+    for env, out_file_path in outputs:
+        print(("Processing {i} -> {o}".format(i=in_file_path, o=out_file_path)))
+        saved = parser.compact_saved
+
+        if single and parser.engine == ENGINE_REGEX:
+            data = parser.parse(in_file_path)
+        else:
+            data = parser.render(compiled, env)
+
+        if parser.compact:
+            print(("  Compacted {o}, saving {b} bytes.".format(o=out_file_path, b=parser.compact_saved - saved)))
+
+        write_output(out_file_path, data)
+
+        if parser.file_stats is not None:
+            parser.file_stats.bytes_out += len(data)
+
+    result = {'parsed': True, 'hits': parser.include_cache_hits, 'misses': parser.include_cache_misses}
+    if parser.file_stats is not None:
+        result['stats'] = parser.end_file_stats()
+
+    if track:
+        # With --replace, the output depends on every define, whether or not the file's macros use it.
+        result['names'] = None if parser.replace_defines else sorted(compiled.names)
+        result['includes'] = sorted(compiled.included_paths())
+
+    return result
+
+
+def file_signature(path, previous=None):
+    """
+    Returns the mtime, size and SHA-1 of a file. The file is only read (and hashed) when its mtime
+    or size differ from the 'previous' signature, so unchanged files only cost a stat().
+    """
+    st = os.stat(path)
+
+    if previous and previous['mtime'] == st.st_mtime and previous['size'] == st.st_size:
+        return previous
+
+    fp = open(path, 'rb')
+    digest = hashlib.sha1(fp.read()).hexdigest()
+    fp.close()
+
+    return {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': digest}
+
+
+def relevant_env(names, env):
+    """
+    Returns the part of env that can change the output of a file using the given define names. A
+    names of None stands for every name (as with --replace, where any define may appear in the file.)
+    """
+    if names is None:
+        names = env.keys()
+
+    return dict((key, repr(env[key])) for key in names if key in env)
+
+
+def manifest_header(parser):
+    """
+    Returns the settings an --incremental manifest is only valid for, as they change the output of
+    every file. The build time only counts when it was set (see MacroEngine.fixed_build_time), or
+    every run would rebuild everything.
+    """
+    build_time = parser.fixed_build_time()
+
+    return {'version': __version__, 'engine': parser.engine, 'compact': parser.compact, 'replace_defines': parser.replace_defines,
+            'build_time': build_time.isoformat() if build_time is not None else None}
+
+
+def load_manifest(destdir, parser):
+    """
+    Loads the --incremental manifest from destdir. A missing or unreadable manifest, or one written
+    with other settings (see manifest_header), is treated as empty (which rebuilds everything.)
+    """
+    try:
+        fp = open("{d}/{m}".format(d=destdir, m=MANIFEST_NAME), 'r')
+        try:
+            manifest = json.load(fp)
+        finally:
+            fp.close()
+
+    except (IOError, OSError, ValueError):
+        return {}
+
+    header = manifest_header(parser)
+    if dict((key, manifest.get(key)) for key in header) != header:
+        return {}
+
+    return manifest.get('files', {})
+
+
+def save_manifest(destdir, parser, files):
+    # With no files to output (an empty tree, or one -e excludes entirely), nothing has created destdir yet.
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+
+    fp = open("{d}/{m}".format(d=destdir, m=MANIFEST_NAME), 'w')
+    manifest = manifest_header(parser)
+    manifest['files'] = files
+    json.dump(manifest, fp, indent=1, sort_keys=True)
+    fp.close()
+
+
+def check_manifest_entry(entry, in_file_path, outputs, seed_env, signatures):
+    """
+    Returns an updated copy of a manifest entry if the file's outputs are up to date, or None if the
+    file needs processing. 'signatures' caches file signatures for the run, so a header included by
+    many files is only checked once.
+    """
+    if not entry:
+        return None
+
+    for env, out_file_path in outputs:
+        if not os.path.exists(out_file_path):
+            return None
+
+        if entry['outputs'].get(out_file_path) != relevant_env(entry.get('names', []), seed_env if env is None else env):
+            return None
+
+    entry = dict(entry)
+
+    try:
+        source = file_signature(in_file_path, entry['source'])
+        if source['sha1'] != entry['source']['sha1']:
+            return None
+
+        entry['source'] = source
+
+        includes = {}
+        for path, previous in entry.get('includes', {}).items():
+            if path not in signatures:
+                signatures[path] = file_signature(path, previous)
+
+            if signatures[path]['sha1'] != previous['sha1']:
+                return None
+
+            includes[path] = signatures[path]
+
+        entry['includes'] = includes
+
+    except (IOError, OSError):
+        return None
+
+    return entry
+
+
+# Guards the stats totals, which the engines spawn()ed for several threads share.
+_stats_lock = threading.Lock()
+
+# Each worker process in a --jobs pool has its own MacroEngine, created by _init_worker().
+_worker = {}
+
+
+def _init_worker(engine_class, settings, seed_env, stats=False):
+    # The worker's caches last for the whole run, as the pool only lives that long.
+    _worker['parser'] = engine_class(settings['engine'])
+    for name, value in settings.items():
+        setattr(_worker['parser'], name, value)
+
+    _worker['seed_env'] = seed_env
+
+    # The records are sent back with the results, and added up (and passed to the hook) by the parent.
+    if stats:
+        _worker['parser'].enable_stats()
+
+
+def _run_worker_task(task):
+    """
+    Runs process_source_file() in a worker, and returns its result along with everything it
+    printed, so the parent can print the logs in order.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+
+    try:
+        result = process_source_file(_worker['parser'], _worker['seed_env'], *task)
+        return result, sys.stdout.getvalue()
+
+    finally:
+        sys.stdout = stdout
+
+
+def scan_and_parse_dir(srcdir, destdir, excludes, parser, variants=None, jobs=1, incremental=False, manifest=None, assets=ASSET_UPDATE, shard=None):
+    """
+    Processes every file under srcdir into destdir.
+
+    @param    variants       List       Optional (name, env) pairs. When given, the tree is walked and each file is
+                                        compiled only once, and rendered into destdir/NAME for every variant.
+    @param    jobs           Integer    The number of processes to spread the files over. Logs are printed in the
+                                        same (sorted) order whatever the number of jobs.
+    @param    incremental    Boolean    Skip the files whose source, included files and relevant defines haven't
+                                        changed since the last run (as recorded in destdir/MANIFEST_NAME.) Their
+                                        outputs aren't touched, so they keep their mtimes.
+    @param    manifest       Dictionary An in-memory manifest to use (and update) instead of the one in destdir. Implies
+                                        incremental.
+    @param    assets         String     How the non-js files are put into destdir (one of ASSET_STRATEGIES.)
+    @param    shard          Tuple      Optional (K, N): only process the files in shard K of N (see shard_of()), and
+                                        list them in a shard manifest in destdir for merge_shards().
+    """
+    seed_env = dict(parser.env)
+    parser.clear_caches()
+
+    if variants:
+        destdirs = [("{d}/{n}".format(d=destdir, n=name), env) for name, env in variants]
+    else:
+        destdirs = [(destdir, None)]
+
+    saved_manifest = manifest
+    if saved_manifest is not None:
+        incremental = True
+    elif incremental:
+        manifest = load_manifest(destdir, parser)
+    else:
+        manifest = {}
+
+    entries = {}
+    signatures = {}
+    skipped = 0
+
+    # The output dirs are created up-front (once per directory), so the workers never race to create them.
+    created = set()
+    tasks = []
+    tree = []
+    shard_files = {}
+    for dir, filename in walk_source_files(srcdir, excludes):
+        if shard:
+            rel_path = "{d}/{f}".format(d=dir, f=filename) if dir else filename
+            tree.append(rel_path)
+
+            if shard_of(rel_path, shard[1]) != shard[0]:
+                continue
+
+            shard_files[rel_path] = [os.path.relpath(join_path(base, dir, filename), destdir).replace(os.sep, '/') for base, env in destdirs]
+
+        in_file_path = join_path(srcdir, dir, filename)
+        outputs = []
+
+        for base, env in destdirs:
+            out_path = join_path(base, dir)
+
+            if out_path not in created:
+                if not(os.path.isdir(out_path)):
+                    os.makedirs(out_path)
+
+                created.add(out_path)
+
+            outputs.append((env, "{p}/{f}".format(p=out_path, f=filename)))
+
+        if incremental:
+            entry = check_manifest_entry(manifest.get(in_file_path), in_file_path, outputs, seed_env, signatures)
+            if entry is not None:
+                entries[in_file_path] = entry
+                skipped += 1
+                continue
+
+        tasks.append((in_file_path, outputs, incremental, assets))
+
+    count = 0
+    passed = 0
+    hits = 0
+    misses = 0
+    copied = 0
+    unchanged = 0
+    results = []
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (parser.__class__, parser.get_settings(), seed_env, parser.stats is not None))
+
+        try:
+            for result, log in pool.imap(_run_worker_task, tasks, max(1, len(tasks) // (jobs * 8))):
+                sys.stdout.write(log)
+                results.append(result)
+
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
+
+    else:
+        for task in tasks:
+            results.append(process_source_file(parser, seed_env, *task))
+
+    for (in_file_path, outputs, track, strategy), result in zip(tasks, results):
+        if result['parsed']:
+            count += 1
+            passed += result.get('passthrough', 0)
+            hits += result['hits']
+            misses += result['misses']
+
+            if 'stats' in result:
+                parser.record_stats(result['stats'])
+        else:
+            copied += result['copied']
+            unchanged += result['unchanged']
+
+        if incremental:
+            names = result.get('names', [])
+            entries[in_file_path] = {
+                'source': file_signature(in_file_path),
+                'includes': dict((path, signatures.get(path) or file_signature(path)) for path in result.get('includes', [])),
+                'names': names,
+                'outputs': dict((out_file_path, relevant_env(names, seed_env if env is None else env)) for env, out_file_path in outputs),
+            }
+
+    parser.reset(seed_env)
+
+    if incremental:
+        if saved_manifest is None:
+            save_manifest(destdir, parser, entries)
+        else:
+            saved_manifest.clear()
+            saved_manifest.update(entries)
+
+        print("Skipped {s} unchanged files.".format(s=skipped))
+
+    if shard:
+        save_shard_manifest(destdir, parser, shard, shard_files, tree)
+        print("Shard {k}/{n} holds {c} of the {t} files.".format(k=shard[0], n=shard[1], c=len(shard_files), t=len(tree)))
+
+    if len(results) > count:
+        print("Copied {b} bytes of assets ({u} already up to date.)".format(b=copied, u=unchanged))
+
+    if passed:
+        print("Passed {p} files without macros straight through.".format(p=passed))
+
+    if hits or misses:
+        print("Include cache: {h} hits, {m} misses.".format(h=hits, m=misses))
+
+    if variants:
+        print(("Processed {c} files into {v} variants.".format(c=count, v=len(variants))))
+    else:
+        print(("Processed {c} files.".format(c=count)))
+
+
+def parse_shard(spec):
+    """
+    Turns a --shard value of the form K/N into a (K, N) pair.
+    """
+    mo = re.match("(\\d+)/(\\d+)$", spec.strip())
+
+    if mo is None or not 1 <= int(mo.group(1)) <= int(mo.group(2)):
+        raise MacroError("--shard must be K/N, with K from 1 to N, not '{s}'".format(s=spec))
+
+    return int(mo.group(1)), int(mo.group(2))
+
+
+def shard_of(rel_path, count):
+    """
+    Returns the shard (from 1 to 'count') a file belongs to, from a hash of its path relative to
+    srcdir, so every machine splits a tree the same way.
+    """
+    return int(hashlib.sha1(rel_path.encode('utf-8')).hexdigest()[:8], 16) % count + 1
+
+
+def tree_digest(rel_paths):
+    return hashlib.sha1("\n".join(sorted(rel_paths)).encode('utf-8')).hexdigest()
+
+
+def save_shard_manifest(destdir, parser, shard, files, tree):
+    """
+    Writes the manifest of a --shard build: the files of the shard (by path relative to srcdir) with
+    their outputs (relative to destdir), and the size and digest of the whole tree, which lets
+    merge_shards() tell that the shards together cover it.
+    """
+    # A shard can be given none of the files, and then nothing else has created destdir.
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+
+    fp = open("{d}/{m}".format(d=destdir, m=SHARD_MANIFEST_NAME.format(k=shard[0], n=shard[1])), 'w')
+    json.dump({'version': __version__, 'engine': parser.engine, 'shard': list(shard), 'files': files,
+               'tree': {'count': len(tree), 'sha1': tree_digest(tree)}}, fp, indent=1, sort_keys=True)
+    fp.close()
+
+
+def load_shard_manifests(sharddir):
+    """
+    Returns the shard manifests found in sharddir, by file name.
+    """
+    manifests = {}
+
+    for path in sorted(glob.glob(os.path.join(sharddir, SHARD_MANIFEST_GLOB))):
+        fp = open(path, 'r')
+        try:
+            manifests[os.path.basename(path)] = json.load(fp)
+
+        except ValueError:
+            raise MacroError("{p} is not a shard manifest".format(p=path))
+
+        finally:
+            fp.close()
+
+    return manifests
+
+
+def merge_shards(destdir, sharddirs=None):
+    """
+    Checks that the --shard builds in sharddirs (or in destdir, when the shards were all built into
+    it) cover every file of the source tree exactly once, and copies their outputs (and manifests)
+    into destdir. Returns the list of problems found; nothing is copied unless it's empty.
+    """
+    sharddirs = sharddirs or [destdir]
+    shards = {}
+    problems = []
+
+    for sharddir in sharddirs:
+        manifests = load_shard_manifests(sharddir)
+        if not manifests:
+            problems.append("{d} holds no shard manifest".format(d=sharddir))
+
+        for name, manifest in manifests.items():
+            key = tuple(manifest['shard'])
+
+            if key in shards:
+                problems.append("shard {k}/{n} is in both {a} and {b}".format(k=key[0], n=key[1], a=shards[key][0], b=sharddir))
+                continue
+
+            shards[key] = (sharddir, name, manifest)
+
+    if not shards:
+        return problems
+
+    counts = set(n for k, n in shards)
+    trees = set((manifest['tree']['count'], manifest['tree']['sha1']) for sharddir, name, manifest in shards.values())
+    builds = set((manifest['version'], manifest['engine']) for sharddir, name, manifest in shards.values())
+
+    if len(counts) > 1:
+        problems.append("the shards split the tree {c} ways".format(c=" and ".join(str(n) for n in sorted(counts))))
+
+    if len(trees) > 1:
+        problems.append("the shards were built from different source trees")
+
+    if len(builds) > 1:
+        problems.append("the shards were built by different versions or engines of jsmacro")
+
+    if problems:
+        return problems
+
+    n = counts.pop()
+    total, digest = trees.pop()
+    shards = dict((k, shard) for (k, n), shard in shards.items())
+
+    missing = [k for k in range(1, n + 1) if k not in shards]
+    if missing:
+        problems.append("shard{s} {m} of {n} {v} missing".format(
+            s='' if len(missing) == 1 else 's', m=", ".join(str(k) for k in missing), n=n, v='is' if len(missing) == 1 else 'are'))
+
+    owners = {}
+    for k, (sharddir, name, manifest) in sorted(shards.items()):
+        for rel_path in sorted(manifest['files']):
+            if rel_path in owners:
+                problems.append("{f} is in both shard {a} and shard {b}".format(f=rel_path, a=owners[rel_path], b=k))
+                continue
+
+            if shard_of(rel_path, n) != k:
+                problems.append("{f} is in shard {k}, but belongs to shard {b}".format(f=rel_path, k=k, b=shard_of(rel_path, n)))
+
+            owners[rel_path] = k
+
+    if not missing and (len(owners) != total or tree_digest(owners) != digest):
+        problems.append("the shards hold {c} files, but the source tree has {t} (or different ones)".format(c=len(owners), t=total))
+
+    if problems:
+        return problems
+
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+
+    copied = 0
+    for k, (sharddir, name, manifest) in sorted(shards.items()):
+        if os.path.abspath(sharddir) == os.path.abspath(destdir):
+            continue
+
+        for rel_path, outputs in sorted(manifest['files'].items()):
+            for output in outputs:
+                dst = os.path.join(destdir, output)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+
+                link_or_copy(os.path.join(sharddir, output), dst)
+                copied += 1
+
+        fast_copy(os.path.join(sharddir, name), os.path.join(destdir, name))
+
+    print("Merged {n} shards ({f} files) into {d}, copying {c} outputs.".format(n=n, f=total, d=destdir, c=copied))
+
+    return problems
+
+
+def output_files(dirname):
+    """
+    Returns the files under dirname (by path relative to it), leaving out the manifests.
+    """
+    files = set()
+
+    for base, dirs, filenames in os.walk(dirname):
+        for filename in filenames:
+            if not filename.startswith('.jsmacro-'):
+                files.add(os.path.relpath(os.path.join(base, filename), dirname).replace(os.sep, '/'))
+
+    return files
+
+
+def test_shards(count, srcdir=None, excludes=(), parser=None):
+    """
+    Builds srcdir as 'count' --shard processes, each into its own temporary directory, merges
+    them with merge_shards(), and checks the result against a build without --shard. Without a
+    srcdir, a small generated tree is used, with fewer files than shards, so some shards are
+    empty. Returns a list of the problems found (empty if the merged tree matches.)
+    """
+    parser = parser or MacroEngine()
+    tmpdir = tempfile.mkdtemp(prefix='jsmacro-shards-')
+
+    try:
+        if srcdir is None:
+            srcdir = generate_corpus(tmpdir, 4, 20, 0.2, 2, 1, 0.05)
+
+        # Every process gets the same build time, so @__date__ and the like can't tell the builds apart.
+        epoch = int((parser.build_timestamp() - datetime(1970, 1, 1)).total_seconds())
+        options = ["--engine", parser.engine, "--timestamp", str(epoch)]
+        for exclude in excludes:
+            options.extend(["-e", exclude])
+
+        def build(destdir, extra):
+            return subprocess.Popen([sys.executable, os.path.abspath(__file__)] + options + extra + ["-s", srcdir, "-d", destdir],
+                                    stdout=devnull, stderr=subprocess.STDOUT)
+
+        devnull = open(os.devnull, 'w')
+        try:
+            sharddirs = [os.path.join(tmpdir, "shard{k}".format(k=k)) for k in range(1, count + 1)]
+            builds = [build(sharddir, ["--shard", "{k}/{n}".format(k=k, n=count)]) for k, sharddir in enumerate(sharddirs, 1)]
+            builds.append(build(os.path.join(tmpdir, 'full'), []))
+
+            problems = ["build {n} exited with status {s}".format(n=n, s=status)
+                        for n, status in enumerate([process.wait() for process in builds], 1) if status]
+
+        finally:
+            devnull.close()
+
+        if problems:
+            return problems
+
+        merged = os.path.join(tmpdir, 'merged')
+        problems = merge_shards(merged, sharddirs)
+        if problems:
+            return problems
+
+        full = os.path.join(tmpdir, 'full')
+        expected = output_files(full)
+        found = output_files(merged)
+
+        problems.extend("{f} is missing from the merged tree".format(f=path) for path in sorted(expected - found))
+        problems.extend("{f} is only in the merged tree".format(f=path) for path in sorted(found - expected))
+
+        for path in sorted(expected & found):
+            if file_signature(os.path.join(full, path))['sha1'] != file_signature(os.path.join(merged, path))['sha1']:
+                problems.append("{f} differs from the build without --shard".format(f=path))
+
+        if not problems:
+            empty = len([sharddir for sharddir in sharddirs if not output_files(sharddir)])
+            print("{n} shards ({e} of them empty) merged into the same {c} files as a build without --shard.".format(n=count, e=empty, c=len(expected)))
+
+        return problems
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def snapshot_tree(srcdir, excludes, manifest):
+    """
+    Returns the (mtime, size) of every file under srcdir, and of every file they include.
+    """
+    paths = [join_path(srcdir, dir, filename) for dir, filename in walk_source_files(srcdir, excludes)]
+
+    for entry in manifest.values():
+        paths.extend(entry.get('includes', {}))
+
+    snapshot = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            snapshot[path] = (st.st_mtime, st.st_size)
+
+        except OSError:
+            snapshot[path] = None
+
+    return snapshot
+
+
+def watch_and_parse_dir(srcdir, destdir, excludes, parser, variants=None, jobs=1, interval=WATCH_INTERVAL, polls=None, assets=ASSET_UPDATE):
+    """
+    Processes srcdir like scan_and_parse_dir, then polls the tree every 'interval' seconds. When a
+    file changes, the files that need it (itself, and anything including it) are processed again.
+
+    The manifest is kept in memory between runs, and polling only costs a walk of the tree and a
+    stat() per file, so nothing needs native file system notifications. A change is picked up
+    within 'interval' seconds, and each rebuild reports how long it took.
+
+    A build that fails (e.g. on a half-typed macro) is reported, and watching goes on. The files
+    that weren't processed stay out of date in the manifest, so they're retried on the next change.
+
+    @param    polls    Integer    Stop after this many polls (None keeps watching until interrupted.)
+    """
+    manifest = {}
+
+    def build():
+        try:
+            scan_and_parse_dir(srcdir, destdir, excludes, parser, variants, jobs, manifest=manifest, assets=assets)
+            return True
+
+        except (MacroError, IOError, OSError) as err:
+            print("Error: {e}".format(e=err))
+            return False
+
+    build()
+
+    snapshot = snapshot_tree(srcdir, excludes, manifest)
+    print("Watching {s} for changes.".format(s=srcdir))
+
+    try:
+        while polls is None or polls > 0:
+            if polls is not None:
+                polls -= 1
+
+            time.sleep(interval)
+
+            current = snapshot_tree(srcdir, excludes, manifest)
+            if current == snapshot:
+                continue
+
+            started = time.time()
+            if build():
+                print("Rebuilt in {t:.1f} ms.".format(t=(time.time() - started) * 1000.0))
+                snapshot = snapshot_tree(srcdir, excludes, manifest)
+            else:
+                # Wait for the next change before trying again, rather than failing on every poll.
+                snapshot = current
+
+    except KeyboardInterrupt:
+        print("Stopped watching {s}.".format(s=srcdir))
+
+
+def expand_inputs(patterns):
+    """
+    Expands the glob patterns in a list of input files (each pattern's matches are sorted),
+    keeping the order the patterns were given in.
+    """
+    paths = []
+
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern)))
+        else:
+            paths.append(pattern)
+
+    return paths
+
+
+def bundle_files(in_file_paths, out_file_path, parser):
+    """
+    Processes the input files, in order, into a single output written with one write ('-' for
+    stdout.) The files share the parser's env, so a //@define in one applies to the files after it.
+
+    Each file is only output once: an input that was already bundled (or pulled in with
+    //@include_once) is skipped, and an //@include_once of a file that's already in the bundle
+    outputs nothing. Returns the number of files bundled.
+    """
+    chunks = []
+    count = 0
+
+    for in_file_path in in_file_paths:
+        key = parser.source_key(in_file_path)
+        if key in parser.included_once:
+            continue
+
+        parser.included_once.add(key)
+        chunks.append(parser.parse(in_file_path))
+        count += 1
+
+    data = ''.join(chunks)
+
+    if out_file_path == '-':
+        sys.stdout.write(data)
+
+    else:
+        write_output(out_file_path, data)
+
+        print("Bundled {c} of {n} files into {o} ({b} bytes.)".format(c=count, n=len(in_file_paths), o=out_file_path, b=len(data)))
+
+    return count
+
+
+# ---------------------------------
+#          SERVE
+# ---------------------------------
+class ServeCache(object):
+    """
+    The output of each .js file served by serve_dir(), with the signatures (mtime and size) of
+    the file and the files it includes. An entry is used for as long as none of them changed,
+    which only costs a stat() per file.
+    """
+    def __init__(self, srcdir, parser):
+        self.srcdir = srcdir
+        self.parser = parser
+        self.entries = {}
+
+    def signatures(self, paths):
+        try:
+            return [(stat.st_mtime, stat.st_size) for stat in map(os.stat, paths)]
+
+        except OSError:
+            return None
+
+    def get(self, path):
+        """
+        Returns (body, etag, hit) for a .js file, processing it if it changed since it was last
+        served. Raises a MacroError if it can't be processed.
+        """
+        entry = self.entries.get(path)
+        if entry is not None and self.signatures(entry['paths']) == entry['signatures']:
+            return entry['body'], entry['etag'], True
+
+        # Each request gets its own engine (see MacroEngine.spawn()), as the server is threaded.
+        parser = self.parser.spawn()
+        compiled = parser.compile(path)
+        paths = [path] + sorted(compiled.included_paths())
+
+        if parser.engine == ENGINE_REGEX:
+            output = parser.parse(path)
+        else:
+            output = parser.render(compiled)
+
+        body = output if isinstance(output, bytes) else output.encode('utf-8')
+        entry = {
+            'paths': paths,
+            'signatures': self.signatures(paths),
+            'body': body,
+            'etag': '"{h}"'.format(h=hashlib.sha1(body).hexdigest()[:20]),
+        }
+        self.entries[path] = entry
+
+        return entry['body'], entry['etag'], False
+
+
+class ServeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of a ServeCache's srcdir. The response headers say how long the request took
+    (Server-Timing, which browsers show in their developer tools) and whether the output came from
+    the cache (X-Jsmacro-Cache.)
+    """
+    cache = None
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body):
+        started = timer()
+        srcdir = os.path.realpath(self.cache.srcdir)
+        path = os.path.realpath(os.path.join(srcdir, unquote(urlsplit(self.path).path).lstrip('/')))
+
+        if not (path == srcdir or path.startswith(srcdir + os.sep)) or not os.path.isfile(path):
+            return self.send_text(404, "Not found: {p}\n".format(p=self.path), started, send_body)
+
+        headers = {}
+
+        if path.endswith('.js'):
+            try:
+                body, etag, hit = self.cache.get(path)
+
+            except MacroError as err:
+                return self.send_text(500, "Error: {e}\n".format(e=err), started, send_body)
+
+            content_type = 'application/javascript; charset=utf-8'
+            headers['X-Jsmacro-Cache'] = 'hit' if hit else 'miss'
+
+        else:
+            fp = open(path, 'rb')
+            body = fp.read()
+            fp.close()
+
+            stat = os.stat(path)
+            etag = '"{m:x}-{s:x}"'.format(m=int(stat.st_mtime * 1000), s=stat.st_size)
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        headers['ETag'] = etag
+        headers['Cache-Control'] = 'no-cache'
+
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, None, headers, started, False)
+
+        headers['Content-Type'] = content_type
+        self.send(200, body, headers, started, send_body)
+
+    def send_text(self, code, text, started, send_body):
+        self.send(code, text.encode('utf-8'), {'Content-Type': 'text/plain; charset=utf-8'}, started, send_body)
+
+    def send(self, code, body, headers, started, send_body):
+        self.send_response(code)
+
+        for name, value in sorted(headers.items()):
+            self.send_header(name, value)
+
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+
+        self.send_header('Server-Timing', 'jsmacro;dur={t:.2f}'.format(t=(timer() - started) * 1000.0))
+        self.end_headers()
+
+        if send_body and body is not None:
+            self.wfile.write(body)
+
+
+class ServeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_dir(srcdir, parser, port=SERVE_PORT, host=SERVE_HOST):
+    """
+    Serves srcdir over HTTP until interrupted, processing the .js files with 'parser' (and its
+    env) as they're requested. Returns the server if 'port' is None (for tests), in which case
+    the caller starts it.
+    """
+    handler = type('Handler', (ServeHandler, object), {'cache': ServeCache(srcdir, parser)})
+    server = ServeHTTPServer((host, port or 0), handler)
+
+    if port is None:
+        return server
+
+    print("Serving {s} on http://{h}:{p}/".format(s=srcdir, h=host, p=server.server_address[1]))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        print("Stopped serving {s}.".format(s=srcdir))
+
+    finally:
+        server.server_close()
+
+
+# ---------------------------------
+#          TEST
+# ---------------------------------
+def find_test_files(dirname):
+    """
+    Returns the (in_file_path, out_file_path) pairs of the test cases under dirname, sorted by
+    path. A test's number is its index in this list, so it doesn't depend on the order the file
+    system lists the files in.
+    """
+    cases = []
+
+    for root, dirs, files in os.walk(dirname):
+        for in_filename in files:
+            if in_filename.endswith('in.js'):
+                in_file_path = "{d}/{f}".format(d=root, f=in_filename)
+                out_file_path = "{d}/{f}out.js".format(d=root, f=in_filename[:-5])
+                cases.append((in_file_path, out_file_path))
+
+    return sorted(cases)
+
+
+def run_test_case(parser, seed_env, test_index, in_file_path, out_file_path):
+    """
+    Parses a test's input and compares it with the expected output. Returns a dict with the
+    outcome, the time the parse took, and the 'log' the parser printed (e.g. warnings.)
+
+    A test whose path contains "always_fail" passes when the output does NOT match, and one whose
+    file name contains "replace" is parsed with --replace.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    parser.reset(seed_env)
+
+    replace_defines = parser.replace_defines
+    parser.replace_defines = replace_defines or "replace" in os.path.basename(in_file_path)
+
+    try:
+        started = timer()
+
+        try:
+            in_parsed = parser.parse(in_file_path)
+            error = None
+
+        except Exception as err:
+            in_parsed = ''
+            error = "{t}: {e}".format(t=err.__class__.__name__, e=err)
+
+        elapsed = timer() - started
+        log = sys.stdout.getvalue()
+
+    finally:
+        sys.stdout = stdout
+        parser.replace_defines = replace_defines
+        parser.reset()
+
+    out_file = open(out_file_path, 'r')
+    out_target_output = out_file.read()
+    out_file.close()
+
+    expect_failure = "always_fail" in in_file_path
+
+    return {
+        'index': test_index,
+        'name': in_file_path,
+        'passed': error is None and (out_target_output == in_parsed) != expect_failure,
+        'expected': out_target_output,
+        'got': in_parsed,
+        'error': error,
+        'seconds': elapsed,
+        'log': log,
+    }
+
+
+def _run_test_task(task):
+    return run_test_case(_worker['parser'], _worker['seed_env'], *task)
+
+
+def junit_report(results, elapsed):
+    """
+    Formats test results as JUnit XML.
+    """
+    failures = len([r for r in results if not r['passed']])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<testsuite name="jsmacro" tests="{t}" failures="{f}" errors="0" time="{s:.6f}">'.format(t=len(results), f=failures, s=elapsed)]
+
+    for result in results:
+        lines.append('  <testcase classname="jsmacro" name={n} time="{s:.6f}">'.format(n=quoteattr(result['name']), s=result['seconds']))
+
+        if not result['passed']:
+            message = result['error'] or "output doesn't match {o}".format(o=result['name'][:-5] + 'out.js')
+            lines.append('    <failure message={m}>{d}</failure>'.format(
+                m=quoteattr(message), d=escape("-- EXPECTED --\n{e}\n-- GOT --\n{g}".format(e=result['expected'], g=result['got']))))
+
+        if result['log']:
+            lines.append('    <system-out>{l}</system-out>'.format(l=escape(result['log'])))
+
+        lines.append('  </testcase>')
+
+    lines.append('</testsuite>')
+
+    return "\n".join(lines) + "\n"
+
+
+def json_test_report(results, elapsed):
+    """
+    Formats test results as JSON.
+    """
+    return json.dumps({
+        'tests': len(results),
+        'passed': len([r for r in results if r['passed']]),
+        'failed': len([r for r in results if not r['passed']]),
+        'seconds': elapsed,
+        'results': [dict((k, v) for k, v in r.items() if k not in ('expected', 'got')) for r in results],
+    }, indent=2, sort_keys=True) + "\n"
+
+
+def scan_for_test_files(dirname, parser, test_index, jobs=1, junit=None, report=None, slowest=TEST_SLOWEST):
+    """
+    Runs the test cases under dirname (all of them, or only number 'test_index' if it's >= 0), and
+    prints the results in order of their test number, whatever the number of jobs. Every test starts
+    from the parser's current env (e.g. the --def values.) The build time is TEST_SOURCE_DATE_EPOCH,
+    so that tests can use @__date__ and the like.
+
+    @param    jobs       Integer    The number of processes to run the tests over, each with its own MacroEngine.
+    @param    junit      String     Optional path to write the results to, as JUnit XML.
+    @param    report     String     Optional path to write the results to, as JSON.
+    @param    slowest    Integer    How many of the slowest tests to list.
+    """
+    seed_env = dict(parser.env)
+    build_time = parser.build_time
+    parser.build_time = epoch_datetime(TEST_SOURCE_DATE_EPOCH)
+
+    tasks = [(n, in_file_path, out_file_path) for n, (in_file_path, out_file_path) in enumerate(find_test_files(dirname))
+             if test_index < 0 or test_index == n]
+
+    started = timer()
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (parser.__class__, parser.get_settings(), seed_env))
+
+        try:
+            results = pool.map(_run_test_task, tasks, max(1, len(tasks) // (jobs * 4)))
+            pool.close()
+
+        finally:
+            pool.terminate()
+            pool.join()
+
+    else:
+        results = [run_test_case(parser, seed_env, *task) for task in tasks]
+
+    elapsed = timer() - started
+    parser.reset(seed_env)
+    parser.build_time = build_time
+
+    num_pass = 0
+    num_fail = 0
 
-__usage__ = """Normal usage:
-  jsmacro.py -f [INPUT_FILE_NAME] > [OUTPUT_FILE]
+    for result in results:
+        sys.stdout.write(result['log'])
+        status = 'PASS' if result['passed'] else 'FAIL'
+        print(("Test {n} - {r} [{s}] ({t:.2f} ms)".format(n=result['index'], r=status, s=result['name'], t=result['seconds'] * 1000.0)))
 
-  Options:
-   --def [VAR[=VALUE]]    Defines the supplied variable (with a default value of 0) in the parser environment.
-   -f|--file [FILE]       Used to load a single input file.
-   -s|--srcdir [DIR]      Used to process all files in the specified directory. Use with -d|--dstdir
-   -d|--dstdir [DIR]      Used to output files processed using -s|--srcdir into the specified directory.
-   -e|--exclude [DIR]     Exclude the files in [DIR] (relative to the directory given in -s|--srcdir).
-   --help                 Prints this Help message.
-   --savefail             Saves the parsed output of a failed test case to disk.
-   --testall              Run the test suite.
-   --test [NUM]           Run test number NUM only.
-   --version              Print the version number of jsmacro being used.
-"""
+        if result['passed']:
+            num_pass = num_pass + 1
+            continue
 
-__credits__ = [
-    'aliclark <https://github.com/aliclark>',
-    'Rodney Lopes Gomes <https://github.com/rlgomes>',
-    'Elan Ruusamae <https://github.com/glensc>',
-]
+        num_fail = num_fail + 1
 
-DEFINE_DEFAULT = '0'
+        if result['error']:
+            print(("  {e}".format(e=result['error'])))
 
+        if parser.save_failure_output:
+            # Write the expected output file for local diffing
+            fout = open('{s}_expected'.format(s=result['name'][:-5] + 'out.js'), 'w')
+            fout.write(result['got'])
+            fout.close()
 
-class MacroEngine(object):
+        else:
+            print(("\n-- EXPECTED --\n{s}".format(s=result['expected'])))
+            print(("-- GOT --\n{s}".format(s=result['got'])))
+
+    if slowest and len(results) > 1:
+        print("\nSlowest tests:")
+
+        for result in sorted(results, key=lambda r: -r['seconds'])[:slowest]:
+            print(("  {t:8.2f} ms  Test {n} [{s}]".format(t=result['seconds'] * 1000.0, n=result['index'], s=result['name'])))
+
+    if junit:
+        fp = open(junit, 'w')
+        fp.write(junit_report(results, elapsed))
+        fp.close()
+
+    if report:
+        fp = open(report, 'w')
+        fp.write(json_test_report(results, elapsed))
+        fp.close()
+
+    if num_pass + num_fail:
+        print(("\n{t} tests - {r}% passed ({p} passed, {f} failed) in {s:.2f} ms".format(t=num_pass + num_fail, p=num_pass, f=num_fail, r=(num_pass / float(num_pass + num_fail) * 100.0), s=elapsed * 1000.0)))
+
+    return num_pass, num_fail
+
+
+
+# ---------------------------------
+#          BENCHMARK
+# ---------------------------------
+def benchmark_lines(sizes=(5000, 10000, 20000, 40000, 80000)):
     """
-    The MacroEngine is where the magic happens. It defines methods that are called
-    to handle the macros found in a document.
+    Times the parse of generated files with a @__line__ on every line, for each engine. If the
+    line substitution is linear, the time per line stays flat as the files grow.
     """
-    def __init__(self):
-        self.save_failure_output = False
-
-        self.re_else_pattern = '[\t ]*//[@#]else[\r]?[\n]'
+    print("{e:>8} {n:>8} {s:>10} {u:>10}".format(e="engine", n="lines", s="seconds", u="us/line"))
 
-        # Compile the main patterns
-        self.re_define_macro = re.compile("([\t ]*//[@#]define[\t ]+)(\w+)([\t ]+(\w+))?[\r]?[\n]", re.I)
-        self.re_define_cmdline_macro = re.compile("(\w+)[\=](\w+)", re.I)
-        self.re_include_macro = re.compile("([\t ]*//[@#]include[\t ]+)([^\r\n]+)[\r]?[\n]", re.I)
+    for engine in ENGINES:
+        parser = MacroEngine(engine)
 
-        self.re_date_sub_macro = re.compile("[@#]__date__", re.I)
-        self.re_time_sub_macro = re.compile("[@#]__time__", re.I)
-        self.re_datetime_sub_macro = re.compile("[@#]__datetime__", re.I)
-        self.re_file_sub_macro = re.compile("[@#]__file__", re.I)
-        self.re_line_sub_macro = re.compile("[@#]__line__", re.I)
+        for size in sizes:
+            fd, path = tempfile.mkstemp(suffix='.js')
+            fp = os.fdopen(fd, 'w')
+            fp.write(''.join(["var line{n} = @__line__;\n".format(n=n) for n in range(size)]))
+            fp.close()
 
-        self.re_stripline_macro = re.compile(".*//[@#]strip.*[\r]?[\n]", re.I)
+            try:
+                started = time.time()
+                parser.parse(path)
+                elapsed = time.time() - started
 
-        # A wrapped macro takes the following form:
-        #
-        # //@MACRO <ARGUMENTS>
-        # ...some code
-        # //@end
-        self.re_wrapped_macro = re.compile("([\t ]*//[@#])([a-z]+)\s+([\w_]*?\s)(.*?)([\t ]*//[@#]end(if)?)\s*?[\r]?[\n]", re.M | re.S)
+            finally:
+                os.remove(path)
 
-        self.reset()
+            parser.reset()
 
-    def reset(self):
-        self.env = {}
+            print("{e:>8} {n:>8} {s:>10.4f} {u:>10.2f}".format(e=engine, n=size, s=elapsed, u=elapsed * 1000000.0 / size))
 
-    def do_define(self, key, value=DEFINE_DEFAULT):
-        if key in self.env:
-            return
 
-        self.env[key] = eval(value)
+def generate_corpus(dirname, files, lines, density, depth, fanout, line_density, seed=0):
+    """
+    Writes a synthetic source tree to dirname/src: 'files' JavaScript files of 'lines' lines, with
+    their //@includes under dirname/src/include. The same arguments (and seed) always produce the
+    same tree. Returns the path of the source dir.
+    """
+    rand = random.Random(seed)
+    srcdir = os.path.join(dirname, 'src')
+    incdir = os.path.join(srcdir, 'include')
+    os.makedirs(incdir)
 
-    def do_include(self, mo):
-        """
-        Used to include an external (JavaScript) file.
-        """
-        arg = mo.group(2).strip()
+    for n in range(max(fanout, 1)):
+        fp = open(os.path.join(incdir, "inc{n}.js".format(n=n)), 'w')
+        fp.write("//@define INC{n} 1\nvar inc{n} = function() {{ return {n}; }};\n//@if DEBUG\nlog('inc{n}');\n//@end\n".format(n=n))
+        fp.close()
 
-        # open the file (relative to the src file we're working with)
-        # run the parser over it
-        # return the output
-        return self.parse(os.path.realpath('{base}/{arg}'.format(base=self._basepath, arg=arg)))
+    for n in range(files):
+        out = ["//@define DEBUG {d}\n".format(d=n % 2), "//@define LEVEL {l}\n".format(l=n % 5)]
+        out.extend(["//@include include/inc{i}.js\n".format(i=i) for i in range(fanout)])
 
-    def handle_if(self, arg, text):
-        """
-        Returns the text to output based on the value of 'arg'.  E.g., if arg evaluates to false,
-        expect to get an empty string back.
+        open_blocks = 0
+        for line in range(lines):
+            roll = rand.random()
 
-        @param    arg    String    Statement found after the 'if'. Currently expected to be a variable (i.e., key) in the env dictionary.
-        @param    text   String    The text found between the macro statements
-        """
-        # To handle the '//@else' statement, we'll split text on the statement.
-        parts = re.split(self.re_else_pattern, text)
+            if roll < density:
+                kind = rand.random()
 
-        try:
-            if self.env[arg]:
-                return "{s}".format(s=parts[0])
+                if open_blocks < depth and kind < 0.4:
+                    out.append(["//@if DEBUG\n", "//@ifdef LEVEL\n", "//@ifndef RELEASE\n"][int(kind * 7.5)])
+                    open_blocks += 1
+                elif open_blocks and kind < 0.7:
+                    out.append("//@end\n")
+                    open_blocks -= 1
+                elif open_blocks and kind < 0.8:
+                    out.append("//@else\n")
+                else:
+                    out.append("console.log('strip {n}'); //@strip\n".format(n=line))
 
+            elif roll < density + line_density:
+                out.append("var at{n} = @__line__;\n".format(n=line))
             else:
-                try:
-                    return "{s}".format(s=parts[1])
+                out.append("var v{n} = {r} * 2; // plain code\n".format(n=line, r=int(rand.random() * 1000)))
 
-                except IndexError:
-                    return ''
+        out.extend(["//@end\n"] * open_blocks)
 
-        except KeyError:
-            print("  Error: {a} is not defined, using unmodified block.".format(a=arg))
-            return "{s}".format(s=text)
+        fp = open(os.path.join(srcdir, "file{n}.js".format(n=n)), 'w')
+        fp.write(''.join(out))
+        fp.close()
 
-    def handle_ifdef(self, arg, text):
-        """
-        @param    arg    String    Statement found after the 'ifdef'. Currently expected to be a variable (i.e., key) in the env dictionary.
-        @param    text   String    The text found between the macro statements
+    return srcdir
 
-        An ifdef is true if the variable 'arg' exists in the environment, regardless of whether
-        it resolves to True or False.
-        """
-        parts = re.split(self.re_else_pattern, text)
 
-        if arg in self.env:
-            return "{s}".format(s=parts[0])
+def load_module(name, path):
+    """
+    Loads a jsmacro script (e.g. jsmacro_25.py) as a module, so different versions can be compared.
+    """
+    try:
+        import importlib.util
 
-        else:
-            try:
-                return "{s}".format(s=parts[1])
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
 
-            except IndexError:
-                return ''
+    except ImportError:
+        import imp
 
-    def handle_ifndef(self, arg, text):
-        """
-        @param    arg    String    Statement found after the 'ifndef'. Currently expected to be a variable (i.e., key) in the env dictionary.
-        @param    text   String    The text found between the macro statements
+        module = imp.load_source(name, path)
 
-        An ifndef is true if the variable 'arg' does not exist in the environment.
-        """
-        parts = re.split(self.re_else_pattern, text)
+    return module
 
-        if arg in self.env:
-            try:
-                return "{s}".format(s=parts[1])
 
-            except IndexError:
-                return ''
+def best_time(func, repeat):
+    """
+    Returns the fastest of 'repeat' runs of func, in seconds.
+    """
+    times = []
 
-        else:
-            return "{s}".format(s=parts[0])
+    for n in range(repeat):
+        started = timer()
+        func()
+        times.append(timer() - started)
 
-    def handle_macro(self, mo):
-        method = mo.group(2)
-        args = mo.group(3).strip()
-        code = mo.group(4)
+    return min(times)
 
-        # This is a fun line.  We construct a method name using the string found in the regex, and call that method on self
-        # with the arguments we have.  So, we can dynamically call methods... (and eventually, we'll support adding methods
-        # at runtime :-)
-        return getattr(self, "handle_{m}".format(m=method))(args, code)
 
-    def parse(self, file_name):
-        now = datetime.now()
+def benchmark_module(module, engine, srcdir, destdir, repeat):
+    """
+    Times one version of jsmacro over a source tree. Returns a dict of stage -> seconds: 'parse'
+    (MacroEngine.parse over every file), 'compile' and 'render' when the version has them, and
+    'dir' (scan_and_parse_dir end to end.)
+    """
+    paths = sorted(os.path.join(srcdir, f) for f in os.listdir(srcdir) if f.endswith('.js'))
+    parser = module.MacroEngine(engine) if engine else module.MacroEngine()
+    clear = getattr(parser, 'clear_caches', lambda: None)
 
-        # Save this for the @import implementation
-        self._basepath = os.path.realpath(os.path.dirname(file_name))
+    def each_file(func):
+        def run():
+            clear()
 
-        fp = open(file_name, 'r')
-        text = fp.read()
-        fp.close()
+            for path in paths:
+                parser.reset()
+                func(path)
 
-        # Replace supported __foo__ statements
-        # Start with __line__ because it needs the un-preprocessed line number.
-        # This code is more complicated than I would like.
-        line_num = 1
-        prevnl = -1
-        while True:
-            nextnl = text.find('\n', prevnl + 1)
-            if nextnl < 0: break
-            # split into before, after and curline
-            before = text[:prevnl+1]
-            after = text[nextnl+1:]
-            curline = text[prevnl+1:nextnl+1]
-            # do the replacement
-            curline = self.re_line_sub_macro.sub('{l}'.format(l=line_num), curline)
-            # put it back together
-            text = before + curline + after
-            # search again for the next newline since the line number is probably not as long as @__line__
-            nextnl = text.find('\n', prevnl + 1)
-            # set up next loop iteration
-            prevnl = nextnl
-            line_num = line_num + 1
-        
-        # Now replace all other __foo__ statements.
-        # This is for __file__
-        file_name_slashes = file_name
-        file_name_slashes.replace('\\', '/')
+        return run
 
-        text = self.re_date_sub_macro.sub('{s}'.format(s=now.strftime("%b %d, %Y")),
-            self.re_time_sub_macro.sub('{s}'.format(s=now.strftime("%I:%M%p")),
-            self.re_datetime_sub_macro.sub('{s}'.format(s=now.strftime("%b %d, %Y %I:%M%p")),
-            self.re_file_sub_macro.sub('{f}'.format(f=file_name_slashes), text))))
+    stages = {'parse': best_time(each_file(parser.parse), repeat)}
 
-        # Parse for DEFINE statements
-        for mo in self.re_define_macro.finditer(text):
-            if mo:
-                k = mo.group(2)  # key
-                v = mo.group(3)  # value
+    if hasattr(parser, 'compile') and engine != ENGINE_REGEX:
+        stages['compile'] = best_time(each_file(parser.compile), repeat)
 
-                if v is None:
-                    v = DEFINE_DEFAULT
+        compiled = [parser.compile(path) for path in paths]
 
-                self.do_define(k, v)
-                
-        # Parse include statements
-        text = self.re_include_macro.sub(self.do_include, text)
+        def render():
+            for item in compiled:
+                parser.render(item)
 
-        # Delete the DEFINE statements
-        text = self.re_define_macro.sub('', text)
+        stages['render'] = best_time(render, repeat)
 
-        # Drop any lines containing a //@strip statement
-        text = self.re_stripline_macro.sub('', text)
+    def scan_dir():
+        if os.path.exists(destdir):
+            shutil.rmtree(destdir)
 
-        # Do the magic...
-        text = self.re_wrapped_macro.sub(self.handle_macro, text)
+        parser.reset()
 
-        return text
+        # Older versions take (srcdir, destdir, parser), without the excludes.
+        if hasattr(module, 'walk_source_files'):
+            module.scan_and_parse_dir(srcdir, destdir, [], parser)
+        else:
+            module.scan_and_parse_dir(srcdir, destdir, parser)
 
+    stdout = sys.stdout
+    sys.stdout = StringIO()
 
-def scan_and_parse_dir(srcdir, destdir, excludes, parser):
-    count = 0
+    try:
+        stages['dir'] = best_time(scan_dir, repeat)
 
-    for root, dirs, files in os.walk(srcdir):
-        dir = root[len(srcdir) + 1:]
-        dir = dir.replace("\\","/")     # slash works just as well for Windows.
+    finally:
+        sys.stdout = stdout
 
-        # check if the dir is in excludes
-        skip = False
-        for e in excludes:
-            if dir == e or dir.startswith(e + "/"):
-                skip = True
-                break
-        
-        if skip:
-            continue
-        
-        in_path = srcdir
-        out_path = destdir
-        if dir != "":
-            in_path = "{s}/{d}".format(s=srcdir, d=dir)
-            out_path = "{s}/{d}".format(s=destdir, d=dir)
-
-        for filename in files:
-            
-            in_file_path = "{p}/{f}".format(p=in_path, f=filename)
-            out_file_path = "{p}/{f}".format(p=out_path, f=filename)
-
-            if not(os.path.exists(out_path)):
-                os.makedirs(out_path)
-
-            # Copy non-js files to the output dir, even though we're not going to process them.  This is useful in
-            # production environments where you might have other needed media files mixed-in with your JavaScript.
-            if not(filename.endswith('.js')):
-                shutil.copy(in_file_path, out_file_path)
-                print("Copying {i} -> {o}".format(i=in_file_path, o=out_file_path))
-                continue
+    return stages
 
-            print(("Processing {i} -> {o}".format(i=in_file_path, o=out_file_path)))
 
-            data = parser.parse(in_file_path)
-            outfile = open(out_file_path, 'w')
-            outfile.write(data)
-            outfile.close()
+def benchmark_parse_stages(module, engine, srcdir, repeat):
+    """
+    Returns the time MacroEngine.parse spends in each of its stages over a source tree (see
+    ParseStats.seconds), from the fastest of 'repeat' runs with the stats on, or None for versions
+    without stats. These runs are separate from benchmark_module()'s, so its timings don't include
+    the cost of the stats.
+    """
+    paths = sorted(os.path.join(srcdir, f) for f in os.listdir(srcdir) if f.endswith('.js'))
+    parser = module.MacroEngine(engine) if engine else module.MacroEngine()
 
-            count += 1
+    if not hasattr(parser, 'enable_stats'):
+        return None
 
-    print(("Processed {c} files.".format(c=count)))
+    best = None
+    for n in range(repeat):
+        parser.clear_caches()
+        parser.enable_stats()
 
+        for path in paths:
+            parser.reset()
+            parser.parse(path)
 
-# ---------------------------------
-#          TEST
-# ---------------------------------
-def scan_for_test_files(dirname, parser, test_index):
-    num_pass = 0
-    num_fail = 0
-    num_tests = 0
-    for root, dirs, files in os.walk(dirname):
-        for in_filename in files:
-            if in_filename.endswith('in.js'):
-                num_tests = num_tests + 1
-                if test_index >= 0:
-                    if test_index != (num_tests - 1):
-                        continue
-                    
-                in_file_path = "{d}/{f}".format(d=dirname, f=in_filename)
-                out_file_path = "{d}/{f}out.js".format(d=dirname, f=in_filename[:-5])
-
-                in_parsed = parser.parse(in_file_path)
-
-                out_file = open(out_file_path, 'r')
-                out_target_output = out_file.read()
-                out_file.close()
-
-                expect_failure = False
-                if "always_fail" in in_file_path:
-                    expect_failure = True
-
-                if out_target_output == in_parsed:
-                    if expect_failure:
-                        print(("Test {n} - FAIL [{s}]".format(n=num_tests-1,s=in_file_path)))
-                        num_fail = num_fail+1
-                    else:
-                        print(("Test {n} - PASS [{s}]".format(n=num_tests-1,s=in_file_path)))
-                        num_pass = num_pass+1
-                else:
-                    if expect_failure:
-                        print(("Test {n} - PASS [{s}]".format(n=num_tests-1,s=in_file_path)))
-                        num_pass = num_pass+1
-                    else:
-                        print(("Test {n} - FAIL [{s}]".format(n=num_tests-1,s=in_file_path)))
-                        num_fail = num_fail+1
+        if best is None or sum(parser.stats.seconds.values()) < sum(best.values()):
+            best = dict(parser.stats.seconds)
 
-                if (out_target_output == in_parsed) == expect_failure:
-                    if parser.save_failure_output:
-                        # Write the expected output file for local diffing
-                        fout = open('{s}_expected'.format(s=out_file_path), 'w')
-                        fout.write(in_parsed)
-                        fout.close()
+    return best
 
-                    else:
-                        print(("\n-- EXPECTED --\n{s}".format(s=out_target_output)))
-                        print(("-- GOT --\n{s}".format(s=in_parsed)))
 
-                parser.reset()
+def benchmark_suite(scales=BENCH_DEFAULT_SCALES, modules=BENCH_MODULES, repeat=BENCH_REPEAT, seed=0):
+    """
+    Runs benchmark_module() (and benchmark_parse_stages()) for each version of jsmacro (and each
+    engine it has) on the corpus of each scale, and returns the results as a JSON-ready dict. A version that fails on a corpus
+    (e.g. the Python 2.5 snapshot under Python 3) gets an 'error' instead of its timings.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+
+    for scale in scales:
+        params = BENCH_SCALES[scale]
+        workdir = tempfile.mkdtemp(prefix='jsmacro-bench-')
+
+        try:
+            srcdir = generate_corpus(workdir, seed=seed, **params)
+            total = sum(os.path.getsize(os.path.join(srcdir, f)) for f in os.listdir(srcdir) if f.endswith('.js'))
+
+            for index, filename in enumerate(modules):
+                try:
+                    module = load_module("jsmacro_bench_{n}".format(n=index), os.path.join(here, filename))
+
+                except Exception as err:
+                    results.append({'module': filename, 'scale': scale, 'params': params, 'bytes': total,
+                                    'error': "{t}: {e}".format(t=err.__class__.__name__, e=err)})
+                    continue
+
+                for engine in getattr(module, 'ENGINES', (None,)):
+                    sys.stderr.write("Benchmarking {m} ({e}) on the {s} corpus.\n".format(m=filename, e=engine or 'default', s=scale))
+                    result = {'module': filename, 'version': module.__version__, 'engine': engine, 'scale': scale, 'params': params, 'bytes': total}
+
+                    try:
+                        result['seconds'] = benchmark_module(module, engine, srcdir, os.path.join(workdir, 'out'), repeat)
+
+                        stages = benchmark_parse_stages(module, engine, srcdir, repeat)
+                        if stages is not None:
+                            result['parse_stages'] = stages
+
+                    except Exception as err:
+                        result['error'] = "{t}: {e}".format(t=err.__class__.__name__, e=err)
+
+                    results.append(result)
 
-    print(("\n{t} tests - {r}% passed ({p} passed, {f} failed)".format(t=num_pass + num_fail, p=num_pass, f=num_fail, r=(num_pass / float(num_pass + num_fail) * 100.0))))
+        finally:
+            shutil.rmtree(workdir)
 
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'repeat': repeat, 'seed': seed, 'results': results}
 
 
 # --------------------------------------------------
@@ -350,8 +3881,8 @@ if __name__ == "__main__":
 
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                               "hf:s:d:e:",
-                               ["help", "file=", "srcdir=", "dstdir=", "exclude=", "test=", "testall", "def=", "savefail", "version"])
+                               "hf:s:d:e:j:",
+                               ["help", "file=", "bundle=", "srcdir=", "dstdir=", "exclude=", "jobs=", "incremental", "watch", "interval=", "assets=", "replace", "timestamp=", "shard=", "merge=", "testshards=", "compact", "serve", "port=", "stream", "test=", "testall", "junit=", "testjson=", "def=", "engine=", "variant=", "stats=", "savefail", "version", "bench", "benchscale=", "benchlines"])
 
     except getopt.GetoptError as err:
         print((str(err)))
@@ -372,28 +3903,147 @@ if __name__ == "__main__":
             sys.exit(0)
 
     # Next, handle commands that config
+    stats_format = None
+    stats_files = []
+
     for o, a in opts:
         if o in ["--def"]:
-            res = p.re_define_cmdline_macro.match(a)
-            p.do_define(res.group(1), res.group(2))
+            p.do_define(*p.split_cmdline_define(a))
             continue
 
         if o in ["--savefail"]:
             p.save_failure_output = True
             continue
 
+        if o in ["--compact"]:
+            p.compact = True
+            continue
+
+        if o in ["--replace"]:
+            p.replace_defines = True
+            continue
+
+        if o in ["--timestamp"]:
+            try:
+                p.build_time = epoch_datetime(a)
+
+            except MacroError as err:
+                print("Error: {e}".format(e=err))
+                print(__usage__)
+
+                sys.exit(2)
+
+            continue
+
+        if o in ["--stats"]:
+            if a not in STATS_FORMATS:
+                print("Unknown stats format '{a}'.".format(a=a))
+                print(__usage__)
+
+                sys.exit(2)
+
+            stats_format = a
+            p.enable_stats(stats_files.append)
+            continue
+
+        if o in ["--engine"]:
+            if a not in ENGINES:
+                print("Unknown engine '{a}'.".format(a=a))
+                print(__usage__)
+
+                sys.exit(2)
+
+            p.engine = a
+            continue
+
     srcdir = None
     dstdir = None
     excludes = []
+    variants = []
+    jobs = 1
+    incremental = False
+    watch = False
+    interval = WATCH_INTERVAL
+    stream = False
+    assets = ASSET_UPDATE
+    bench_scales = []
+    junit = None
+    report = None
+    serve = False
+    port = SERVE_PORT
+    shard = None
 
     for o, a in opts:
         if o in ["-e", "--exclude"]:
             excludes.append(a)
+
+        if o in ["--variant"]:
+            variants.append(parse_variant(a, p))
+
+        if o in ["-j", "--jobs"]:
+            jobs = int(a)
+
+        if o in ["--incremental"]:
+            incremental = True
+
+        if o in ["--watch"]:
+            watch = True
+
+        if o in ["--stream"]:
+            stream = True
+
+        if o in ["--interval"]:
+            interval = float(a)
+
+        if o in ["--serve"]:
+            serve = True
+
+        if o in ["--port"]:
+            port = int(a)
+
+        if o in ["--shard"]:
+            try:
+                shard = parse_shard(a)
+
+            except MacroError as err:
+                print("Error: {e}".format(e=err))
+                print(__usage__)
+
+                sys.exit(2)
+
+        if o in ["--junit"]:
+            junit = a
+
+        if o in ["--testjson"]:
+            report = a
+
+        if o in ["--benchscale"]:
+            if a not in BENCH_SCALES:
+                print("Unknown benchmark scale '{a}'.".format(a=a))
+                print(__usage__)
+
+                sys.exit(2)
+
+            bench_scales.append(a)
+
+        if o in ["--assets"]:
+            if a not in ASSET_STRATEGIES:
+                print("Unknown asset strategy '{a}'.".format(a=a))
+                print(__usage__)
+
+                sys.exit(2)
+
+            assets = a
     
     # Now handle commands the execute based on the config
     for o, a in opts:
         if o in ["-s", "--srcdir"]:
             srcdir = a
+            p.srcdir = a
+
+            if serve:
+                serve_dir(srcdir, p, port)
+                break
 
         if o in ["-d", "--dstdir"]:
             dstdir = a
@@ -402,25 +4052,117 @@ if __name__ == "__main__":
                 raise Exception("you must set the srcdir when setting a dstdir.")
 
             else:
-                scan_and_parse_dir(srcdir, dstdir, excludes, p)
+                try:
+                    if watch and shard:
+                        raise MacroError("--shard can't be used with --watch")
+                    elif watch:
+                        watch_and_parse_dir(srcdir, dstdir, excludes, p, variants, jobs, interval, assets=assets)
+                    else:
+                        scan_and_parse_dir(srcdir, dstdir, excludes, p, variants, jobs, incremental, assets=assets, shard=shard)
+
+                except MacroError as err:
+                    print("Error: {e}".format(e=err))
+
+                    sys.exit(1)
 
             break
 
         if o in ["-f", "--file"]:
-            print((p.parse(a)))
+            # The output goes to stdout, so nothing else may.
+            p.warnings = sys.stderr
+
+            try:
+                if a == '-':
+                    for chunk in p.parse_stream(sys.stdin, a):
+                        sys.stdout.write(chunk)
+
+                elif stream:
+                    fp = open(a, 'r')
+                    try:
+                        for chunk in p.parse_stream(fp, a):
+                            sys.stdout.write(chunk)
+
+                    finally:
+                        fp.close()
+
+                else:
+                    print((p.parse(a)))
+
+                if p.compact:
+                    sys.stderr.write("Compacted {f}, saving {b} bytes.\n".format(f=a, b=p.compact_saved))
+
+            except MacroError as err:
+                sys.stderr.write("Error: {e}\n".format(e=err))
+
+                sys.exit(1)
+
+            break
+
+        if o in ["--bundle"]:
+            if a == '-':
+                p.warnings = sys.stderr
+
+            try:
+                bundle_files(expand_inputs(args), a, p)
+
+            except MacroError as err:
+                print("Error: {e}".format(e=err))
+
+                sys.exit(1)
+
+            break
+
+        if o in ["--merge"]:
+            try:
+                problems = merge_shards(a, args)
+
+            except (MacroError, IOError, OSError) as err:
+                problems = [err]
+
+            for problem in problems:
+                print("Error: {e}".format(e=problem))
+
+            if problems:
+                sys.exit(1)
+
+            break
+
+        if o in ["--testshards"]:
+            try:
+                problems = test_shards(int(a), srcdir, excludes, p)
+
+            except (MacroError, IOError, OSError, ValueError) as err:
+                problems = [err]
+
+            for problem in problems:
+                print("Error: {e}".format(e=problem))
+
+            if problems:
+                sys.exit(1)
 
             break
 
         if o in ["--test"]:
             print("Running only test {a}.".format(a=a))
-            scan_for_test_files("testfiles", p, int(a))
+            scan_for_test_files("testfiles", p, int(a), jobs, junit, report)
             print("Done.")
             break
 
         if o in ["--testall"]:
             print("Running all tests.")
-            scan_for_test_files("testfiles", p, -1)
+            scan_for_test_files("testfiles", p, -1, jobs, junit, report)
             print("Done.")
             break
 
+        if o in ["--bench"]:
+            print(json.dumps(benchmark_suite(bench_scales or BENCH_DEFAULT_SCALES), indent=2, sort_keys=True))
+            break
+
+        if o in ["--benchlines"]:
+            benchmark_lines()
+            break
+
+    if stats_format is not None:
+        sys.stderr.write(stats_report(p.stats, stats_files, stats_format) + "\n")
+
     sys.exit(0)
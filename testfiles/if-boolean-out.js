@@ -8,5 +8,4 @@ var foo = function() {
   alert('Pass. Foo < Bar.');
 
   alert('Pass. Foo == Bar');
-
 };
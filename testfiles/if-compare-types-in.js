@@ -0,0 +1,19 @@
+//@define FOO 1
+//@define NAME 'ie'
+//@define NONE null
+
+var foo = function() {
+  //@if FOO < 'a'
+  alert('FOO < a');
+  //@else
+  alert('FOO >= a');
+  //@end
+
+  //@if NONE > 1
+  alert('NONE > 1');
+  //@end
+
+  //@if NAME < 'jsmacro' && FOO >= 1
+  alert('PASS');
+  //@end
+};
@@ -0,0 +1,10 @@
+
+var foo = function() {
+  alert('FOO < a');
+  //@else
+  alert('FOO >= a');
+
+  alert('NONE > 1');
+
+  alert('PASS');
+};
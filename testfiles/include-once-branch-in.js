@@ -0,0 +1,9 @@
+
+var foo = function() {
+  //@ifdef LEGACY
+  //@include_once include-data.js
+  //@end
+  //@include_once include-data.js
+  //@include_once include-data.js
+  alert(bar);
+};
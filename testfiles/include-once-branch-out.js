@@ -0,0 +1,5 @@
+
+var foo = function() {
+  var bar = "Hello World";
+  alert(bar);
+};
@@ -0,0 +1,7 @@
+
+var foo = function() {
+  //@include_once include-data.js
+  //@include_once ../testfiles/include-data.js
+  //@include include-data.js
+  alert(bar);
+};
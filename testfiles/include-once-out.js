@@ -0,0 +1,6 @@
+
+var foo = function() {
+  var bar = "Hello World";
+  var bar = "Hello World";
+  alert(bar);
+};
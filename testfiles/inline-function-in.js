@@ -0,0 +1,42 @@
+//@define DEBUG 0
+
+//@inline
+function square(x) {
+  return x * x;
+}
+
+var clamp = function(value, low, high) {
+  return value < low ? low : (value > high ? high : value);
+};
+
+function cube(x) { return square(x) * x; }
+//@end
+
+//@inline lerp
+function lerp(a, b, t) {
+  return a + (b - a) * t;
+}
+
+function log(message) {
+  console.log(message);
+}
+//@end
+
+var step = function(points, t) {
+  var total = 0;
+
+  for (var i = 0; i < points.length; i++) {
+    total += square(points[i].x) + cube(points[i].y);
+    total += clamp(points[i].z, -1, 1) + lerp(points[i].x, points[i].y, t);
+  }
+
+  //@if DEBUG
+  log("square(total) is " + square(total));
+  //@end
+
+  // Left alone: square(x) in comments and strings, method calls, and calls that can't be inlined.
+  var label = "square(" + total + ")";
+  var other = points.square(2) + square(next()) + square(1, 2) + clamp(lerp(0, total, t), 0, 1);
+
+  return lerp(total, other, t);
+};
@@ -0,0 +1,34 @@
+
+function square(x) {
+  return x * x;
+}
+
+var clamp = function(value, low, high) {
+  return value < low ? low : (value > high ? high : value);
+};
+
+function cube(x) { return (x * x) * x; }
+
+function lerp(a, b, t) {
+  return a + (b - a) * t;
+}
+
+function log(message) {
+  console.log(message);
+}
+
+var step = function(points, t) {
+  var total = 0;
+
+  for (var i = 0; i < points.length; i++) {
+    total += (points[i].x * points[i].x) + ((points[i].y * points[i].y) * points[i].y);
+    total += (points[i].z < (-1) ? (-1) : (points[i].z > 1 ? 1 : points[i].z)) + (points[i].x + (points[i].y - points[i].x) * t);
+  }
+
+
+  // Left alone: square(x) in comments and strings, method calls, and calls that can't be inlined.
+  var label = "square(" + total + ")";
+  var other = points.square(2) + square(next()) + square(1, 2) + clamp((0 + (total - 0) * t), 0, 1);
+
+  return (total + (other - total) * t);
+};
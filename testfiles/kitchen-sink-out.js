@@ -1,11 +1,21 @@
-// kitchen-sink-in.js line 1
+// testfiles/kitchen-sink-in.js line 1
+
 
 // Blah PASS
 
+
 var foo = function() {
-  alert('A basic define value. This line should be in the output.');
+  // The ABCDE line should be in the output.
+  alert('ABCDE');
+
+
+  // The RAINDROP line should be in the output.
+  alert('RAINDROP');
+
+  // The CATMAGIC line should be in the output.
+  var bar = "CATMAGIC";
 
-  var bar = "This line has no macro influencing it, thus should be visible.";
+  // The BITS line should be in the output.
+  alert('BITS');
 
-  alert('Foo or BAR is defined so this line should be in the output.');
 };
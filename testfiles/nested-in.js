@@ -0,0 +1,25 @@
+//@define DEBUG 1
+//@define IE6 0
+
+var foo = function() {
+  //@if DEBUG
+  log('debug');
+  //@if IE6
+  log('debug on IE6');
+  //@else
+  log('debug elsewhere');
+  //@ifdef TRACE
+  trace();
+  //@end
+  //@end
+  //@endif
+
+  //@ifndef IE6
+  modern();
+  //@else
+  //@if DEBUG
+  log('IE6 is defined');
+  //@end
+  legacy();
+  //@endifndef
+};
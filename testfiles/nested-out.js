@@ -0,0 +1,8 @@
+
+var foo = function() {
+  log('debug');
+  log('debug elsewhere');
+
+  log('IE6 is defined');
+  legacy();
+};
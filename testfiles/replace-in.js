@@ -0,0 +1,21 @@
+//@define API_URL "https://example.com/api"
+//@define DEBUG 0
+//@define RETRIES 3
+
+// API_URL is left alone in comments, /* and DEBUG in block comments, */
+var config = {
+  url: API_URL,
+  label: "API_URL",
+  other: 'DEBUG',
+  template: `${API_URL}/users, not API_URL`,
+  retries: RETRIES * 2,
+  API_URL_FALLBACK: null,
+  DEBUG: DEBUG ? 1 : 0,
+  RETRIES
+};
+
+var flags = {API_URL, DEBUG, RETRIES: [RETRIES, DEBUG, RETRIES]};
+
+if (DEBUG) {
+  console.log(config.API_URL, window.DEBUG, f(DEBUG, RETRIES, API_URL));
+}
@@ -0,0 +1,18 @@
+
+// API_URL is left alone in comments, /* and DEBUG in block comments, */
+var config = {
+  url: "https://example.com/api",
+  label: "API_URL",
+  other: 'DEBUG',
+  template: `${"https://example.com/api"}/users, not API_URL`,
+  retries: 3 * 2,
+  API_URL_FALLBACK: null,
+  DEBUG: 0 ? 1 : 0,
+  RETRIES: 3
+};
+
+var flags = {API_URL: "https://example.com/api", DEBUG: 0, RETRIES: [3, 0, 3]};
+
+if (0) {
+  console.log(config.API_URL, window.DEBUG, f(0, 3, "https://example.com/api"));
+}
@@ -0,0 +1,7 @@
+
+/*
+  Built at @__datetime__
+*/
+var foo = function() {
+  alert("This code was processed on @__date__ at @__time__");
+};
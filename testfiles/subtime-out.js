@@ -0,0 +1,7 @@
+
+/*
+  Built at Feb 19, 2010 08:30PM
+*/
+var foo = function() {
+  alert("This code was processed on Feb 19, 2010 at 08:30PM");
+};
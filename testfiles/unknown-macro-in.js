@@ -0,0 +1,11 @@
+//@define DEBUG 1
+
+var foo = function() {
+  //@frobnicate DEBUG
+  log('frobnicated');
+  //@end
+
+  //@if DEBUG
+  log('debug');
+  //@end
+};
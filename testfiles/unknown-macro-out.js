@@ -0,0 +1,8 @@
+
+var foo = function() {
+  //@frobnicate DEBUG
+  log('frobnicated');
+  //@end
+
+  log('debug');
+};